@@ -1,15 +1,216 @@
 import sublime
 import sublime_plugin
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from collections.abc import Mapping
 # import pprint
 import re
+import fnmatch
 import time
 import subprocess
 # import tempfile
 import os
+import string
+import threading
+import json
+import base64
+import queue
+import socket
+import http.client
+import hashlib
+import shutil
+import shlex
+import multiprocessing
+import heapq
+import concurrent.futures
+import traceback
+import contextlib
+import math
+import codecs
+from types import MappingProxyType
+from functools import partial
 
 DEBUG_MODE = True
 
+# name of the default/user settings file of this package
+SETTINGS_FILE = 'Spandoc.sublime-settings'
+
+# resolved settings, keyed by the path of the settings file they came from:
+# {settings_file_path: (stamp, settings)}
+# the settings of the default/user settings file are stored under SETTINGS_FILE
+settings_cache = {}
+settings_cache_lock = threading.Lock()
+
+# indexes of the folder settings files inside the project folders:
+# {(project_folder, settings_file_name): FolderSettingsIndex}
+folder_settings_indexes = {}
+folder_settings_indexes_lock = threading.Lock()
+
+# pandoc server: seconds to wait for a started server to answer
+PANDOC_SERVER_START_TIMEOUT = 10
+# pandoc server: seconds a conversion may take (`--timeout`, pandoc's default is 2)
+PANDOC_SERVER_TIMEOUT = 300
+# separates the key and the value of `--variable` and `--metadata`
+VARIABLE_SEPARATOR_PATTERN = re.compile(r'[:=]')
+
+# output formats which embed the images of the document, which `pandoc server` can not read
+SERVER_EMBEDDING_FORMATS = frozenset(['docx', 'odt', 'pptx', 'epub', 'epub2', 'epub3', 'fb2'])
+
+# running pandoc servers: {pandoc_path: PandocServer}
+pandoc_servers = {}
+pandoc_servers_lock = threading.Lock()
+
+# the worker process ("pandoc_backend": "worker"), see worker/spandoc_worker.py:
+# seconds to wait for a started worker to answer
+WORKER_START_TIMEOUT = 10
+# held while the worker is started, so it is started once
+worker_lock = threading.Lock()
+
+# pandoc options with an equivalent in the JSON parameters of `pandoc server`:
+# {long option: (type, server parameter name if different)}
+SERVER_OPTIONS = {
+    'to': (str,), 'standalone': (bool,), 'toc': (bool, 'table-of-contents'), 'toc-depth': (int,),
+    'number-sections': (bool,), 'variable': (dict, 'variables'), 'metadata': (dict,),
+    'wrap': (str,), 'columns': (int,), 'tab-stop': (int,), 'preserve-tabs': (bool,),
+    'section-divs': (bool,), 'ascii': (bool,), 'eol': (str,), 'html-q-tags': (bool,),
+    'reference-links': (bool,), 'reference-location': (str,), 'top-level-division': (str,),
+    'slide-level': (int,), 'incremental': (bool,), 'shift-heading-level-by': (int,),
+    'id-prefix': (str, 'identifier-prefix'), 'title-prefix': (str,), 'strip-comments': (bool,),
+    'dpi': (int,), 'email-obfuscation': (str,), 'listings': (bool,),
+    'indented-code-classes': (str,), 'default-image-extension': (str,),
+}
+
+# pandoc options used by the reader, which are part of the AST cache key: {option: type}
+READER_OPTIONS = {
+    'from': str, 'tab-stop': str, 'preserve-tabs': bool, 'indented-code-classes': str,
+    'default-image-extension': str, 'file-scope': bool, 'metadata': str, 'metadata-file': str,
+    'abbreviations': str, 'track-changes': str, 'extract-media': str, 'shift-heading-level-by': str,
+    'base-header-level': str, 'strip-comments': bool,
+}
+# pandoc arguments with a file as value, whose content is part of the output cache key
+FILE_OPTIONS = frozenset([
+    'template', 'include-in-header', 'include-before-body', 'include-after-body', 'css', 'bibliography', 'csl',
+    'citation-abbreviations', 'reference-doc', 'reference-docx', 'reference-odt', 'filter', 'lua-filter', 'defaults',
+    'metadata-file', 'abbreviations', 'syntax-definition', 'highlight-style', 'epub-cover-image', 'epub-metadata',
+    'epub-embed-font', 'epub-stylesheet',
+])
+
+# pandoc arguments are parsed by PandocArguments, options are stored by their long name
+LONG_OPTION_PATTERN = re.compile(r'^--([^=\s]+)(?:=(.*))?$', re.DOTALL)
+SHORT_OPTION_PATTERN = re.compile(r'^-([A-Za-z])(.*)$', re.DOTALL)
+# {short option: (long option, takes a value)}
+SHORT_OPTIONS = {
+    't': ('to', True), 'w': ('to', True), 'f': ('from', True), 'r': ('from', True), 'o': ('output', True),
+    's': ('standalone', False), 'V': ('variable', True), 'M': ('metadata', True), 'c': ('css', True),
+    'H': ('include-in-header', True), 'B': ('include-before-body', True), 'A': ('include-after-body', True),
+    'N': ('number-sections', False), 'F': ('filter', True), 'L': ('lua-filter', True), 'd': ('defaults', True),
+    'p': ('preserve-tabs', False), 'i': ('incremental', False), 'C': ('citeproc', False), 'T': ('title-prefix', True),
+    'D': ('print-default-template', True), 'S': ('smart', False), 'R': ('parse-raw', False),
+}
+# long options with another name for the same option
+OPTION_ALIASES = {'write': 'to', 'read': 'from', 'table-of-contents': 'toc'}
+# long options without a value (options with an optional value, like --mathjax, need "=")
+FLAG_OPTIONS = frozenset([
+    'standalone', 'toc', 'number-sections', 'preserve-tabs', 'incremental', 'citeproc', 'natbib', 'biblatex',
+    'section-divs', 'ascii', 'html-q-tags', 'reference-links', 'strip-comments', 'listings', 'file-scope',
+    'self-contained', 'embed-resources', 'no-highlight', 'no-check-certificate', 'sandbox', 'verbose', 'quiet',
+    'fail-if-warnings', 'trace', 'mathjax', 'mathml', 'katex', 'webtex', 'gladtex', 'smart', 'parse-raw',
+    'normalize', 'chapters', 'atx-headers', 'no-wrap', 'link-images', 'list-tables', 'version', 'help',
+])
+
+# versions of the used pandoc executables: {pandoc_path: first line of `pandoc --version`}
+pandoc_versions = {}
+pandoc_versions_lock = threading.Lock()
+# formats of the used pandoc executables: {pandoc_path: (input formats, output formats)}, probed by get_pandoc_formats
+pandoc_formats = {}
+# found pandoc executables: {"pandoc_path" setting: path}, see find_pandoc
+pandoc_paths = {}
+# an extension of a format, e.g. "+smart" in "markdown+smart"
+FORMAT_EXTENSION_PATTERN = re.compile(r'[+-]')
+
+# sharded conversions (see get_shards): formats whose output can be stitched together from the outputs of the shards
+SHARD_INPUT_FORMATS = frozenset([
+    'markdown', 'commonmark', 'commonmark_x', 'gfm', 'markdown_strict', 'markdown_mmd', 'markdown_phpextra', 'markdown_github',
+])
+SHARD_OUTPUT_FORMATS = SHARD_INPUT_FORMATS | frozenset(['html', 'html4', 'html5', 'plain'])
+# options which need the whole document (numbering, table of contents, citations, filters)
+SHARD_UNSUPPORTED_OPTIONS = frozenset([
+    'toc', 'toc-depth', 'number-sections', 'number-offset', 'citeproc', 'bibliography', 'natbib', 'biblatex', 'filter',
+    'lua-filter', 'defaults', 'file-scope', 'reference-links', 'reference-location', 'self-contained', 'embed-resources',
+])
+# options only used for the standalone document, not for the shards
+SHARD_STANDALONE_OPTIONS = ('standalone', 'template', 'include-in-header', 'include-before-body', 'include-after-body', 'css')
+SHARD_HEADING_PATTERN = re.compile(r'^ {0,3}#(?:[ \t]|$)')
+SHARD_SETEXT_PATTERN = re.compile(r'^ {0,3}=+[ \t]*$')
+SHARD_FENCE_PATTERN = re.compile(r'^ {0,3}(`{3,}|~{3,})')
+SHARD_REFERENCE_PATTERN = re.compile(r'^ {0,3}\[[^\]^][^\]]*\]:[ \t]')
+SHARD_FOOTNOTE_PATTERN = re.compile(r'^ {0,3}\[\^[^\]]+\]:|\^\[', re.MULTILINE)
+# fenced divs (an opening fence has attributes or a class), HTML comments and HTML blocks, whose headings are not split at
+SHARD_DIV_FENCE_PATTERN = re.compile(r'^ {0,3}:{3,}[ \t]*(\S)?')
+SHARD_HTML_PATTERN = re.compile(
+    r'<!--|-->|<(/?)(?:address|article|aside|blockquote|center|details|dialog|div|dl|fieldset|figure|footer|form|header|main|'
+    r'nav|noscript|ol|pre|script|section|style|table|ul)\b', re.IGNORECASE)
+# headings of all levels (for their identifiers), their attributes and the bracketed text of links
+SHARD_ANY_HEADING_PATTERN = re.compile(r'^ {0,3}#{1,6}(?:[ \t]+(.*?))?[ \t#]*$')
+SHARD_ANY_SETEXT_PATTERN = re.compile(r'^ {0,3}(?:=+|-+)[ \t]*$')
+SHARD_ATTRIBUTES_PATTERN = re.compile(r'[ \t]*\{([^{}]*)\}[ \t]*$')
+SHARD_BRACKETS_PATTERN = re.compile(r'\[([^\[\]\n]+)\]')
+# stands for the body, when the standalone header and footer are made
+SHARD_PLACEHOLDER = 'SpandocShardedBodyPlaceholder'
+
+# incremental PDF builds (see get_pdf_engine): the LaTeX engines run by Spandoc itself
+PDF_ENGINES = frozenset(['pdflatex', 'xelatex', 'lualatex'])
+# options of the engine, not of the LaTeX writer
+PDF_ENGINE_OPTIONS = ('pdf-engine', 'latex-engine', 'pdf-engine-opt', 'latex-engine-opt')
+# files written by LaTeX, which are read by the next run (the engine is rerun while they change)
+PDF_RERUN_EXTENSIONS = ('.aux', '.toc', '.lof', '.lot', '.out', '.nav', '.snm')
+PDF_MAX_RUNS = 4
+# the images of a document (markdown, HTML, LaTeX), and the image formats LaTeX reads itself: pandoc downloads
+# remote images and converts the others (SVG, GIF, ...) only when it makes the PDF, so these are left to pandoc
+PDF_IMAGE_PATTERN = re.compile(r'!\[[^\]]*\]\([ \t]*(?:<([^>]+)>|([^\s)]+))|<img\b[^>]*?\bsrc[ \t]*=[ \t]*["\']?([^"\'\s>]+)|\\includegraphics(?:\[[^\]]*\])?\{([^}]+)\}', re.IGNORECASE)
+PDF_IMAGE_REFERENCE_PATTERN = re.compile(r'!\[([^\]]*)\](?:\[([^\]]*)\])?(?!\()')
+PDF_REFERENCE_DEFINITION_PATTERN = re.compile(r'^ {0,3}\[([^\]]+)\]:[ \t]*<?([^\s>]+)', re.MULTILINE)
+PDF_URL_PATTERN = re.compile(r'^(?:[a-zA-Z][a-zA-Z0-9+.-]+:|//)')
+PDF_NATIVE_IMAGE_EXTENSIONS = frozenset(['', '.pdf', '.png', '.jpg', '.jpeg'])
+# locks of the build directories, so one document is not built twice at once: {build dir: Lock}
+pdf_build_locks = {}
+pdf_build_locks_lock = threading.Lock()
+
+# the scheduler running all conversions, see get_scheduler()
+scheduler = None
+scheduler_lock = threading.Lock()
+# job priorities, lower runs first: conversions of the active view, then batches (Convert to All, Build Project)
+PRIORITY_ACTIVE = 0
+PRIORITY_BATCH = 1
+
+# file extensions and their scopes, for the project build (on Sublime Text 4, others are looked up)
+BUILD_SCOPES = {
+    '.md': 'text.html.markdown', '.markdown': 'text.html.markdown', '.mdown': 'text.html.markdown',
+    '.mkd': 'text.html.markdown', '.html': 'text.html.basic', '.htm': 'text.html.basic',
+    '.tex': 'text.tex.latex', '.rst': 'text.restructuredtext', '.textile': 'text.html.textile',
+}
+
+# pp macros including other files, e.g. `!include(chapter.md)`
+PP_INCLUDE_PATTERN = re.compile(r'!(?:include|import|rawinclude|csv)\s*\(\s*([^)\n]+?)\s*\)')
+
+# the timings of the last conversions (see Timing), shown by SpandocStatsCommand
+TIMINGS_SIZE = 1000
+timings = deque(maxlen=TIMINGS_SIZE)
+timings_lock = threading.Lock()
+
+# the output of pandoc is read in chunks of this size (and streamed to its view, see BufferWriter)
+OUTPUT_CHUNK_SIZE = 64 * 1024
+# the output panel showing the stderr of pandoc (warnings and errors), as it arrives
+PANDOC_PANEL = 'spandoc_pandoc'
+# the last bytes of stderr, which are kept for the error message of a failed conversion
+ERROR_TAIL_SIZE = 64 * 1024
+
+# running live previews: {view id: LivePreview}
+live_previews = {}
+
+# the pp preprocessor (http://cdsoft.fr/pp/), activated with `"use_pp": true`
+# the output extension is defined as a symbol (for referencing)
+PP_PREPROCESSOR = ('pp', '-D', '$output_extension', '$file')
+
 class SpandocPaletteCommand(sublime_plugin.WindowCommand):
 
     '''See README.md for more information on this command'''
@@ -20,13 +221,18 @@ class SpandocPaletteCommand(sublime_plugin.WindowCommand):
         view, folder_path, file_name = get_current(self.window)
         # debug("folder_path: " + folder_path)
         # debug("file_name: " + file_name)
+        timing = Timing('palette', None, file_name)
 
         # get the user settings:
-        settings = get_settings(view, folder_path)
+        settings = get_settings(view, folder_path, timing)
         # debug("settings: " + str(settings))
+        if settings is None:
+            return
 
         # get transformation list for the current view
-        self.transformation_list = self.get_transformation_list(settings, view)
+        with timing.span('ranking'):
+            self.transformation_list = self.get_transformation_list(settings, view)
+        timing.record(settings, 'ok' if self.transformation_list else 'error')
 
         # show the transformation list with Sublimes "Quick Panel", and for the picked transformation the picked_transformation function will be executed, which will then pass the picked transformation to the SpandocCommand
         self.window.show_quick_panel(self.transformation_list, self.picked_transformation)
@@ -35,24 +241,12 @@ class SpandocPaletteCommand(sublime_plugin.WindowCommand):
     def get_transformation_list(self, settings, view):
         '''Generates a ranked list of available transformations.'''
 
-        # score the transformations and rank them
-        ranked = {}
-        for label, setting in settings['transformations'].items():
-            for scope in setting['scope']:
-                score = view.score_selector(0, scope)
-                if not score:
-                    continue
-                if label not in ranked or ranked[label] < score:
-                    ranked[label] = score
+        transformation_list = rank_transformations(settings, view)
 
-        if not len(ranked):
+        if not len(transformation_list):
             sublime.error_message('No transformations configured for the syntax '+ view.settings().get('syntax'))
             return
 
-        # reverse sort
-        transformation_list = list(OrderedDict(sorted(
-            ranked.items(), key=lambda t: t[1])).keys())
-        transformation_list.reverse()
         return transformation_list
 
 
@@ -77,257 +271,2760 @@ class SpandocRunCommand(sublime_plugin.WindowCommand):
 
         # return currently edited view, dir and filename from the window
         view, folder_path, file_name_with_ext = get_current(self.window)
+        timing = Timing('run', transformation, file_name_with_ext)
 
-        # split the name of the file and its extension
-        file_name, input_extension = os.path.splitext(file_name_with_ext)
+        # unsaved views are converted inside the first project folder
+        if folder_path is None and self.window.folders():
+            folder_path = self.window.folders()[0]
 
         # get the user settings:
-        settings = get_settings(view, folder_path)
+        settings = get_settings(view, folder_path, timing)
+        if settings is None:
+            return
 
-        # gets pandoc executable from settings
-        pandoc_path = settings['pandoc_path']
-        if pandoc_path is None:
-            sublime.error_message('Could not find pandoc executable. Do you have set the "pandoc_path" parameter in the settings?')
-        # debug("pandoc_path: " + str(pandoc_path))
-
-        # get all the items from picked transformation out of the settings
-        transformation = settings['transformations'][transformation]
-        # debug("transformations: " + str(transformation))
-
-        pandoc_arguments = transformation['pandoc-arguments']
-        # debug("pandoc_arguments: " + str(pandoc_arguments))
-        pandoc_arguments = evaluate_short_long_arguments(pandoc_arguments)
-        # debug("pandoc_arguments: " + str(pandoc_arguments))
-
-
-        # output_format / `--to` parameter
-        output_format = pandoc_arguments.get(short=['t', 'w'], long=['to', 'write'])
-        if output_format is None:
-            sublime.error_message('Could not find Pandocs `--to` argument. Do you have set the `--to` argument inside the `pandoc-arguments` array in the settings?')
-        # debug("output_format: " + str(output_format))
-
-        # input_format / `--from` parameter
-        score = 0
-        for scope, input_format in transformation['scope'].items():
-            c_score = view.score_selector(0, scope)
-            if c_score <= score:
-                continue
-            score = c_score
+        try:
+            with timing.span('prepare'):
+                conversion = prepare_conversion(self.window, view, folder_path, file_name_with_ext, settings, transformation)
+        except ConversionError as e:
+            timing.record(settings, 'error')
+            sublime.error_message(str(e))
+            return
+        conversion.timing = timing
+        clear_pandoc_panel(self.window)
 
-        if input_format is None:
-            sublime.error_message('Could not find Pandocs `--from` argument. Do you have set the scopes dictionary in the settings?')
-        # debug("input_format: " + str(input_format))
+        # Pass the conversion to the scheduler, which runs the preprocessors and Pandoc in a worker thread
+        get_scheduler().submit(lambda: self.run_conversion(conversion), PRIORITY_ACTIVE, conversion)
 
 
-        # Display Result in Buffer (Buffer not yet implemented) or write to a file?
-        output_name = pandoc_arguments.get(short=['o'], long=['output'])
+    def run_conversion(self, conversion):
 
-        # display in Buffer (Buffer not yet implemented)
-        if output_name is None:
-                # The output file will have the same name as the input file, unless otherwise specified with the `--output` option.
-                output_name = file_name
+        # a result for a buffer is streamed into it, as pandoc writes it
+        sink = get_buffer_writer(conversion)
+        try:
+            result = self.convert(conversion, sink)
+        except ConversionCancelled:
+            return
+        except ConversionError as e:
+            sublime.error_message(str(e))
+            return
+        self.finish(conversion, result)
+
+        # Output Status message done:
+        if conversion.warnings:
+            sublime.status_message("Spandoc DONE, with warnings (see the output panel)")
+        else:
+            sublime.status_message("Spandoc DONE")
 
-                # todo: buffer
-                # buffer_on = True
-                # for now, ALWAYS add the output parameter:
-                # pandoc_arguments.extend(['-o', output_name])
 
+    def convert(self, conversion, sink=None):
+        '''Run a conversion and return its output (raises ConversionError).
 
-        # use output_extension as specified in the output_extension parameter,
-        # if it is not specified or blank, use output_format as from the file output_extension,
+        With a sink (a BufferWriter), the output of a buffer conversion may be
+        streamed to it instead; None is returned then.
+        The timing of the conversion is recorded, whether it succeeds or not.'''
+
+        outcome = 'error'
         try:
-            transformation['output_extension']
-        except:
-            output_extension = output_format
+            result = self.convert_timed(conversion, sink)
+            outcome = 'ok'
+        except ConversionCancelled:
+            outcome = 'cancelled'
+            raise
+        finally:
+            conversion.timing.record(conversion.settings, outcome)
+        return result
+
+
+    def convert_timed(self, conversion, sink=None):
+
+        timing = conversion.timing
+
+        # Optional: take the output from the output cache, if this exact conversion has been done before
+        cache = get_output_cache(conversion.settings)
+        cache_key = None
+        if cache is not None and not conversion.preprocessors:
+            with timing.span('cache'):
+                cache_key = get_output_cache_key(conversion)
+                placed = cache_key is not None and cache.place(cache_key, conversion.output_path())
+            if placed:
+                debug("Took the output from the output cache: " + cache_key)
+                result = cache.read(cache_key) if conversion.output_name is None else b''
+                timing.count_output(conversion, result)
+                return result
+
+        shards = get_shards(conversion) if conversion.transformation.get('sharded') is True else None
+        pdf_engine = get_pdf_engine(conversion)
+        if shards is not None:
+            result = self.pass_to_pandoc_sharded(conversion, *shards)
+        elif conversion.server_params is not None:
+            result = self.pass_to_pandoc_server(conversion)
+        elif pdf_engine is not None:
+            result = self.pass_to_pandoc_pdf(conversion, pdf_engine)
+        elif conversion.settings.get('pandoc_backend') == 'worker' and not conversion.preprocessors and hasattr(socket, 'AF_UNIX'):
+            result = self.pass_to_pandoc_worker(conversion)
+        elif conversion.settings.get('ast_cache_size') and not conversion.preprocessors:
+            result = self.pass_to_pandoc_ast(conversion)
+        elif cache_key is None and sink is not None:
+            result = self.pass_to_pandoc(conversion, sink=sink)
+            timing.count('output_bytes', sink.size)
+            return result
         else:
-            output_extension = transformation['output_extension']
-        # debug("output_extension: " + str(output_extension))
+            result = self.pass_to_pandoc(conversion)
+        timing.count_output(conversion, result)
 
+        if cache_key is not None:
+            with timing.span('cache'):
+                if conversion.output_name is None:
+                    cache.put_bytes(cache_key, result)
+                else:
+                    cache.put_file(cache_key, conversion.output_path())
+        return result
+
+
+    def pass_to_pandoc(self, conversion, pandoc_cmd=None, contents=None, sink=None):
+        '''Run pandoc (after the preprocessors) and return its stdout.
+
+        pandoc_cmd and contents (stdin) replace the ones of the conversion, if given.
+        With a sink, stdout is passed to it in chunks as it arrives, and None is returned.
+        stderr is shown in the pandoc output panel as it arrives; it only fails the
+        conversion, when pandoc exits with an error code (otherwise these are warnings).'''
+
+        folder_path = conversion.folder_path
+        if pandoc_cmd is None:
+            pandoc_cmd = conversion.pandoc_cmd
+        if contents is None:
+            contents = conversion.contents
+        preprocessors = conversion.preprocessors
+
+        # start the preprocessors, each one reading the stdout of its predecessor; their
+        # stderr is drained in the background, so a chatty preprocessor can not block the pipeline
+        timing = conversion.timing
+        with timing.span('preprocessors'):
+            if contents is not None and preprocessors and conversion.preprocessor_input is None:
+                # the first preprocessor gets the buffer content instead of the file
+                stages = start_preprocessors(preprocessors, folder_path, input_bytes=contents)
+                contents = None
+            else:
+                stages = start_preprocessors(preprocessors, folder_path, conversion.preprocessor_input)
+        for unused_cmd, preprocessor, unused_error in stages:
+            conversion.started(preprocessor)
+        if stages:
+            stdin = stages[-1][1].stdout
+        else:
+            stdin = subprocess.PIPE if contents is not None else subprocess.DEVNULL
+
+        with timing.span('startup'):
+            try:
+                process = popen(pandoc_cmd, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=folder_path)
+            except OSError as e:
+                kill_stages(stages)
+                raise ConversionError('Could not run ' + format_command(pandoc_cmd) + '\n\n' + str(e))
+        conversion.started(process)
+        if stages:
+            # only pandoc holds the read end of the last pipe now
+            stdin.close()
+        elif contents is not None:
+            feed(process.stdin, contents)
+        errors = PandocErrors(process.stderr, conversion, pandoc_cmd)
+
+        # stdout is read in chunks; if there is a result pandoc has put the conversion in stdout,
+        # when result is empty it has written to a file
+        # (with preprocessors, this includes their runtime, as pandoc reads their output)
+        chunks = []
+        with timing.span('pandoc'):
+            for chunk in iter(lambda: process.stdout.read(OUTPUT_CHUNK_SIZE), b''):
+                if sink is not None:
+                    sink.write(chunk)
+                else:
+                    chunks.append(chunk)
+            process.stdout.close()
+            returncode = process.wait()
+            errors.join()
+        timing.count('error_bytes', errors.size)
+
+        # killed by Conversion.cancel()
+        if conversion.cancelled:
+            raise ConversionCancelled()
+
+        # Handle preprocessor errors
+        for preprocessor_cmd, preprocessor, preprocessor_error in stages:
+            if preprocessor.wait() != 0:
+                raise ConversionError('\n\n'.join(['Error when running:', format_command(preprocessor_cmd), b''.join(preprocessor_error).decode('utf-8', 'replace').strip()]))
+
+        # Handle Pandoc errors, its output on stderr without an error code are warnings
+        if returncode != 0:
+            message = errors.text() or 'pandoc exited with code ' + str(returncode)
+            raise ConversionError('\n\n'.join(['Error when running:', format_command(pandoc_cmd), message]))
+        if errors.size:
+            conversion.warnings += 1
+
+        if sink is not None:
+            sink.close()
+            return None
+        return b''.join(chunks)
+
+
+    def pass_to_pandoc_ast(self, conversion):
+        '''Run pandoc in two steps: the reader (to a JSON AST, which is cached) and then the writer.
+
+        Several transformations of an unchanged document parse it only once.'''
+
+        contents = conversion.read_input()
+
+        pandoc_path = conversion.pandoc_cmd[0]
+        reader_arguments, writer_arguments = split_reader_arguments(conversion.pandoc_arguments)
+        reader_cmd = [pandoc_path, '-f', conversion.input_format] + reader_arguments + ['-t', 'json']
+        writer_cmd = [pandoc_path, '-f', 'json'] + writer_arguments
+
+        key = hashlib.sha256()
+        key.update(str(get_pandoc_version(pandoc_path)).encode('utf-8'))
+        key.update(json.dumps(reader_cmd).encode('utf-8'))
+        key.update(contents)
+        # the files read by the reader (--metadata-file, --abbreviations, ...), like in get_output_cache_key
+        for name, value in conversion.pandoc_arguments.items():
+            if name in READER_OPTIONS and name in FILE_OPTIONS and value and value is not True:
+                key.update(b'\0' + name.encode('utf-8') + b'\0')
+                hash_file(key, os.path.join(conversion.folder_path or '', os.path.expanduser(value)))
+
+        max_size = conversion.settings.get('ast_cache_size') * 1024 * 1024
+        ast = ast_cache.get(key.hexdigest(), lambda: self.pass_to_pandoc(conversion, reader_cmd, contents), max_size)
+        debug("pandoc_cmd (writer): " + format_command(writer_cmd))
+        return self.pass_to_pandoc(conversion, writer_cmd, ast)
+
+
+    def pass_to_pandoc_sharded(self, conversion, metadata, shards):
+        '''Convert the shards of a document in parallel and stitch their outputs together.
+
+        The shards are converted without --standalone; for a standalone output, the
+        header and footer are made once, from the metadata and a placeholder body.
+        Converted shards are kept in the shard cache, so after an edit only the
+        changed shards are converted again.'''
+
+        pandoc_path = conversion.pandoc_cmd[0]
+        arguments = conversion.pandoc_arguments.copy()
+        arguments.remove('output')
+        standalone = 'standalone' in arguments
+        for name in SHARD_STANDALONE_OPTIONS:
+            arguments.remove(name)
+        shard_cmd = [pandoc_path, '-f', conversion.input_format] + arguments.as_list()
+        debug("pandoc_cmd (" + str(len(shards)) + " shards): " + format_command(shard_cmd))
+
+        version = str(get_pandoc_version(pandoc_path))
+        max_size = conversion.settings.get('shard_cache_size', 64) * 1024 * 1024
+
+        def convert_shard(cmd, shard):
+            key = hashlib.sha256()
+            key.update(version.encode('utf-8'))
+            key.update(json.dumps(cmd).encode('utf-8'))
+            key.update(shard)
+            return shard_cache.get(key.hexdigest(), lambda: self.pass_to_pandoc(conversion, cmd, shard), max_size)
+
+        workers = min(len(shards), get_package_settings().get('max_jobs') or multiprocessing.cpu_count())
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            fragments = list(pool.map(lambda shard: convert_shard(shard_cmd, shard), shards))
+
+        header = footer = b''
+        if standalone:
+            standalone_arguments = conversion.pandoc_arguments.copy()
+            standalone_arguments.remove('output')
+            standalone_cmd = [pandoc_path, '-f', conversion.input_format] + standalone_arguments.as_list()
+            frame = convert_shard(standalone_cmd, metadata + ('\n\n' + SHARD_PLACEHOLDER + '\n').encode('utf-8'))
+            position = frame.find(SHARD_PLACEHOLDER.encode('utf-8'))
+            if position < 0:
+                debug("The placeholder of the body is missing in the standalone output, converting the whole document")
+                return self.pass_to_pandoc(conversion)
+            header = frame[:frame.rfind(b'\n', 0, position) + 1]
+            end = frame.find(b'\n', position)
+            footer = frame[end + 1:] if end >= 0 else b''
+
+        # HTML fragments are joined by a line break, text (markdown, plain) needs a blank line before a heading
+        separator = b'\n' if conversion.output_format.startswith('html') else b'\n\n'
+        result = header + separator.join(fragment.rstrip(b'\r\n') for fragment in fragments) + b'\n' + footer
+
+        if conversion.output_name is not None:
+            output_path = conversion.output_path()
+            with conversion.timing.span('write'):
+                with open(output_path, 'wb') as output_file:
+                    output_file.write(result)
+            return b''
+        return result
+
+
+    def pass_to_pandoc_pdf(self, conversion, engine):
+        '''Make a PDF in two steps: pandoc writes the LaTeX, then the engine is run by Spandoc.
+
+        The LaTeX and the files of the engine (.aux, .toc, ...) are kept in a build
+        directory per output file, so a repeated build needs only one engine run
+        (further runs only while the .aux/.toc files change), and none at all,
+        when the LaTeX is unchanged.'''
+
+        timing = conversion.timing
+        output_path = conversion.output_path()
+        build_dir = get_pdf_build_dir(output_path, engine)
+        job_name = os.path.splitext(os.path.basename(output_path))[0]
+        tex_path = os.path.join(build_dir, job_name + '.tex')
+        pdf_path = os.path.join(build_dir, job_name + '.pdf')
+
+        arguments = conversion.pandoc_arguments.copy()
+        arguments.remove('output')
+        for name in PDF_ENGINE_OPTIONS:
+            arguments.remove(name)
+        arguments.set('standalone')
+        # the command of the conversion up to its arguments (pandoc, the input file and its format)
+        pandoc_cmd = conversion.pandoc_cmd[:len(conversion.pandoc_cmd) - len(conversion.pandoc_arguments.as_list())] + arguments.as_list()
+        debug("pandoc_cmd (LaTeX): " + format_command(pandoc_cmd))
+        latex = self.pass_to_pandoc(conversion, pandoc_cmd)
+
+        with get_pdf_build_lock(build_dir):
+            try:
+                with open(tex_path, 'rb') as tex_file:
+                    unchanged = tex_file.read() == latex
+            except OSError:
+                unchanged = False
+
+            if unchanged and os.path.isfile(pdf_path):
+                debug("The LaTeX of " + output_path + " is unchanged, skipping the engine")
+            else:
+                with open(tex_path, 'wb') as tex_file:
+                    tex_file.write(latex)
+                engine_cmd = [engine, '-interaction=nonstopmode', '-halt-on-error', '-output-directory=' + build_dir]
+                engine_cmd += conversion.pandoc_arguments.get_all('pdf-engine-opt') + conversion.pandoc_arguments.get_all('latex-engine-opt')
+                engine_cmd.append(tex_path)
+                debug("engine_cmd: " + format_command(engine_cmd))
+
+                with timing.span('latex'):
+                    for unused_run in range(PDF_MAX_RUNS):
+                        before = hash_build_files(build_dir, job_name)
+                        # relative paths in the document (images, ...) are resolved from its folder
+                        try:
+                            process = popen(engine_cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=conversion.folder_path)
+                        except OSError as e:
+                            raise ConversionError('Could not run ' + format_command(engine_cmd) + '\n\n' + str(e))
+                        conversion.started(process)
+                        returncode = process.wait()
+                        timing.count('latex_runs', 1)
+                        if conversion.cancelled:
+                            raise ConversionCancelled()
+                        if returncode != 0:
+                            # a half written PDF must not be taken for an up to date one
+                            if os.path.exists(pdf_path):
+                                os.remove(pdf_path)
+                            log_path = os.path.join(build_dir, job_name + '.log')
+                            raise ConversionError('\n\n'.join(['Error when running:', format_command(engine_cmd), get_latex_errors(log_path), 'See: ' + log_path]))
+                        if hash_build_files(build_dir, job_name) == before:
+                            break
+
+            with timing.span('write'):
+                shutil.copyfile(pdf_path, output_path)
+        return b''
+
+
+    def pass_to_pandoc_worker(self, conversion):
+        '''Let the worker process run pandoc, which is shared by all windows and caches the outputs.'''
+
+        files = get_argument_files(conversion.pandoc_arguments)
+        if conversion.file_name is not None and conversion.contents is None:
+            files.insert(0, conversion.file_name)
+        request = {
+            'command': 'convert',
+            'cmd': conversion.pandoc_cmd,
+            'cwd': conversion.folder_path,
+            'input': base64.b64encode(conversion.contents).decode('ascii') if conversion.contents is not None else None,
+            'output': conversion.output_path(),
+            'files': files,
+        }
 
-        # add the output_extension to the name
-        output_name_with_ext = output_name + "." + output_extension
-        # debug("output_name_with_ext: " + str(output_name_with_ext))
+        try:
+            with conversion.timing.span('worker'):
+                response = SpandocWorker(conversion.settings).request(request, conversion)
+        except WorkerUnavailable as e:
+            debug("worker unavailable, using the command line: " + str(e))
+            return self.pass_to_pandoc(conversion)
+
+        # the request was closed by Conversion.cancel()
+        if conversion.cancelled:
+            raise ConversionCancelled()
+
+        stderr = response.get('stderr') or ''
+        conversion.timing.count('error_bytes', len(stderr.encode('utf-8')))
+        if stderr and conversion.window is not None:
+            text = get_pandoc_panel_title(conversion) + stderr
+            sublime.set_timeout(lambda: append_to_pandoc_panel(conversion.window, text), 0)
+        if not response.get('ok'):
+            raise ConversionError('\n\n'.join(['Error when running (in the worker):', format_command(conversion.pandoc_cmd), str(response.get('error'))]))
+        if stderr:
+            conversion.warnings += 1
+        if response.get('cached'):
+            debug("Took the output from the cache of the worker")
+        return base64.b64decode(response.get('output') or '')
+
+
+    def pass_to_pandoc_server(self, conversion):
+
+        # the server gets the text itself, not a file name
+        try:
+            text = conversion.read_input().decode('utf-8')
+        except UnicodeDecodeError as e:
+            raise ConversionError('Could not read ' + str(conversion.file_name) + ' as UTF-8: ' + str(e))
+        params = dict(conversion.server_params, text=text)
+
+        try:
+            with conversion.timing.span('server'):
+                response = get_pandoc_server(conversion.pandoc_cmd[0]).convert(params)
+        except PandocServerUnavailable as e:
+            # fall back to the command line, e.g. for an old pandoc without the `server` command
+            debug("pandoc server unavailable, using the command line: " + str(e))
+            return self.pass_to_pandoc(conversion)
+        except PandocServerError as e:
+            raise ConversionError('\n\n'.join(['Error when converting with the pandoc server:', format_command(conversion.pandoc_cmd), str(e)]))
+
+        # a running request can not be stopped, but its result is dropped
+        if conversion.cancelled:
+            raise ConversionCancelled()
+
+        # the messages of the server are warnings, like the stderr of the command line
+        messages = [format_server_message(message) for message in response.get('messages') or ()]
+        if messages:
+            debug("pandoc server: " + '\n'.join(messages))
+            conversion.warnings += 1
+            if conversion.window is not None:
+                text = get_pandoc_panel_title(conversion) + ''.join(message + '\n' for message in messages)
+                sublime.set_timeout(lambda: append_to_pandoc_panel(conversion.window, text), 0)
+
+        if response.get('base64'):
+            result = base64.b64decode(response['output'])
+        else:
+            result = response['output'].encode('utf-8')
+
+        # write to file
+        if conversion.output_name is not None:
+            output_path = conversion.output_path()
+            with conversion.timing.span('write'):
+                with open(output_path, 'wb') as output_file:
+                    output_file.write(result)
+        return result
 
 
-        # Optional: execute the pp preprocessor before executing pandoc, see: http://cdsoft.fr/pp/
-        # this is activated with the `use_pp=true` keyword in the settings:
+    def finish(self, conversion, result):
 
+        # if write to file, open
+        # if output_format is not None and output_format in get_settings('pandoc-format-file'):
+        #     try:
+        #         if sublime.platform() == 'osx':
+        #             subprocess.call(["open", output_name])
+        #         elif sublime.platform() == 'windows':
+        #             os.startfile(output_name)
+        #         elif os.name == 'posix':
+        #             subprocess.call(('xdg-open', output_name))
+        #     except:
+        #         sublime.message_dialog('Wrote to file ' + output_name)
+        #     return
+
+        # write to buffer (unless it was streamed into it)
+        if conversion.output_name is None and result is not None:
+            text = result.decode('utf-8').replace('\r\n', '\n')
+            sublime.set_timeout(lambda: write_to_buffer(conversion.window, conversion.view, text, conversion.transformation), 0)
+
+
+        # open automatically with the sublime text plugin "view in browser"
+        # self.window.run_command('view_in_browser')
+        # window().run_command("view_in_browser")
+        # view.run_command("view_in_browser")
+        # self.view.window().run_command("save")
+
+
+
+class SpandocRunAllCommand(SpandocRunCommand):
+
+    '''Runs all transformations available for the current view in parallel.
+
+    Only the transformations listed in the "run_all" setting (or passed as the
+    "transformations" argument) are run, when it is given.'''
+
+    def run(self, transformations=None):
+
+        view, folder_path, file_name_with_ext = get_current(self.window)
+        if folder_path is None and self.window.folders():
+            folder_path = self.window.folders()[0]
+
+        settings = get_settings(view, folder_path)
+        if settings is None:
+            return
+
+        names = rank_transformations(settings, view)
+        if transformations is None:
+            transformations = settings.get('run_all')
+        if transformations:
+            names = [name for name in names if name in transformations]
+        if not names:
+            sublime.error_message('No transformations configured for the syntax '+ view.settings().get('syntax'))
+            return
+
+        # prepare all conversions here, they only run in parallel
+        progress = BatchProgress(self.window, view, len(names))
+        conversions = []
+        for name in names:
+            try:
+                conversions.append(prepare_conversion(self.window, view, folder_path, file_name_with_ext, settings, name))
+            except ConversionError as e:
+                progress.done(name, str(e))
+
+        for conversion in conversions:
+            get_scheduler().submit(partial(self.run_batch_conversion, conversion, progress), PRIORITY_BATCH, conversion,
+                on_cancel=partial(progress.done, conversion.name, 'Cancelled'))
+
+
+    def run_batch_conversion(self, conversion, progress):
+
+        sink = get_buffer_writer(conversion)
         try:
-            transformation['use_pp']
-        except:
-            use_pp = False
+            result = self.convert(conversion, sink)
+        except ConversionError as e:
+            progress.done(conversion.name, str(e))
+            return
+        except Exception as e:
+            traceback.print_exc()
+            progress.done(conversion.name, 'Unexpected error: ' + repr(e))
+            return
+        self.finish(conversion, result)
+        progress.done(conversion.name)
+
+
+class BatchProgress(object):
+
+    '''Progress of several conversions running in parallel.
+
+    Shows the progress in the status bar of the converted view and, when all
+    are done, a summary of the successes and failures.'''
+
+    def __init__(self, window, view, total, on_finish=None):
+        self.window = window
+        self.view = view
+        self.total = total
+        self.on_finish = on_finish
+        self.succeeded = []
+        self.failed = []
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def done(self, name, error=None):
+        with self.lock:
+            if error is None:
+                self.succeeded.append(name)
+            else:
+                self.failed.append((name, error))
+            finished = len(self.succeeded) + len(self.failed)
+        status = "Spandoc: " + str(finished) + "/" + str(self.total) + " done"
+        if self.failed:
+            status += " (" + str(len(self.failed)) + " failed)"
+        if finished < self.total:
+            if self.view is not None:
+                sublime.set_timeout(lambda: self.view.set_status('spandoc', status), 0)
+        else:
+            sublime.set_timeout(self.summarize, 0)
+
+    def summarize(self):
+        if self.on_finish is not None:
+            sublime.set_timeout_async(self.on_finish, 0)
+        if self.view is not None:
+            self.view.erase_status('spandoc')
+        seconds = str(round(time.time() - self.started, 2))
+        if not self.failed:
+            sublime.status_message("Spandoc DONE: " + str(self.total) + " transformations in " + seconds + "s")
+            return
+
+        lines = ["Spandoc: " + str(len(self.succeeded)) + " of " + str(self.total) + " transformations succeeded in " + seconds + "s", ""]
+        lines.extend("OK      " + name for name in self.succeeded)
+        for name, error in self.failed:
+            lines.append("FAILED  " + name)
+            lines.extend("        " + line for line in error.splitlines() if line.strip())
+        show_panel(self.window, '\n'.join(lines) + '\n')
+        sublime.status_message("Spandoc: " + str(len(self.failed)) + " of " + str(self.total) + " transformations FAILED")
+
+
+class Job(object):
+
+    '''A function queued in the JobScheduler, usually running a conversion.'''
+
+    def __init__(self, function, priority, sequence, conversion=None, key=None, on_cancel=None):
+        self.function = function
+        self.priority = priority
+        self.sequence = sequence
+        self.conversion = conversion
+        self.key = key
+        self.on_cancel = on_cancel
+        # pending, running, done or cancelled
+        self.state = 'pending'
+
+
+class JobScheduler(object):
+
+    '''Runs the jobs (conversions) of the whole plugin, at most max_jobs at once.
+
+    Pending jobs run by priority (PRIORITY_ACTIVE before PRIORITY_BATCH) and
+    then in the order they came in. A single conversion (a job without
+    on_cancel) is coalesced with a pending job converting the same input with
+    the same transformation and command (see get_job_key): it is not queued
+    again, so repeating a command quickly runs the conversion only once. Jobs
+    of batches are always queued, as their progress counts every job.
+    cancel_all() drops the pending jobs and kills the processes of the running
+    ones. The number of running and pending jobs is shown in the status bar.'''
+
+    def __init__(self, max_jobs):
+        self.max_jobs = max_jobs
+        # heap of (priority, sequence, job); entries of jobs which are no longer pending are skipped
+        self.queue = []
+        # {coalescing key: pending job}
+        self.pending = {}
+        self.running = set()
+        self.workers = 0
+        self.sequence = 0
+        self.lock = threading.Lock()
+        self.status_view = None
+
+    def submit(self, function, priority=PRIORITY_BATCH, conversion=None, on_cancel=None):
+        key = get_job_key(conversion) if conversion is not None else None
+        with self.lock:
+            job = self.pending.get(key) if key is not None and on_cancel is None else None
+            if job is not None and job.conversion is not None and job.conversion.cancelled:
+                # a cancelled job (e.g. of a live preview) is dropped, the new one is queued instead
+                job.state = 'cancelled'
+                del self.pending[key]
+                job = None
+            if job is not None:
+                debug("Coalesced with a pending job: " + conversion.name)
+                if priority < job.priority:
+                    # the job is pushed again, the entry of its old priority is skipped
+                    job.priority = priority
+                    heapq.heappush(self.queue, (job.priority, job.sequence, job))
+                return job
+            self.sequence += 1
+            job = Job(function, priority, self.sequence, conversion, key, on_cancel)
+            heapq.heappush(self.queue, (job.priority, job.sequence, job))
+            if key is not None:
+                self.pending[key] = job
+            start_worker = self.workers < self.max_jobs
+            if start_worker:
+                self.workers += 1
+        if start_worker:
+            threading.Thread(target=self.work, name='Spandoc worker', daemon=True).start()
+        self.show_status()
+        return job
+
+    def next_job(self):
+        with self.lock:
+            while self.queue and self.workers <= self.max_jobs:
+                priority, unused_sequence, job = heapq.heappop(self.queue)
+                if job.state != 'pending' or priority != job.priority:
+                    continue
+                job.state = 'running'
+                if self.pending.get(job.key) is job:
+                    del self.pending[job.key]
+                self.running.add(job)
+                return job
+            # nothing left to do (or the limit was lowered), the worker ends
+            self.workers -= 1
+            return None
+
+    def work(self):
+        while True:
+            job = self.next_job()
+            if job is None:
+                self.show_status()
+                return
+            self.show_status()
+            try:
+                job.function()
+            except Exception:
+                traceback.print_exc()
+            finally:
+                with self.lock:
+                    self.running.discard(job)
+                    if job.state == 'running':
+                        job.state = 'done'
+
+    def cancel_all(self):
+        '''Drop the pending jobs and cancel the running ones; returns the number of cancelled jobs.'''
+
+        with self.lock:
+            # a job can be in the queue twice, when its priority was raised
+            pending = list(OrderedDict((job, None) for unused_priority, unused_sequence, job in sorted(self.queue, key=lambda entry: entry[:2]) if job.state == 'pending'))
+            running = list(self.running)
+            for job in pending + running:
+                job.state = 'cancelled'
+            self.queue = []
+            self.pending.clear()
+        for job in running:
+            if job.conversion is not None:
+                job.conversion.cancel()
+        for job in pending:
+            if job.on_cancel is not None:
+                job.on_cancel()
+        self.show_status()
+        return len(pending) + len(running)
+
+    def show_status(self):
+        with self.lock:
+            running = len(self.running)
+            pending = len(set(job for unused_priority, unused_sequence, job in self.queue if job.state == 'pending'))
+        sublime.set_timeout(lambda: self.update_status_bar(running, pending), 0)
+
+    def update_status_bar(self, running, pending):
+        window = sublime.active_window()
+        view = window.active_view() if window is not None else None
+        if self.status_view is not None and self.status_view is not view:
+            self.status_view.erase_status('spandoc_jobs')
+        self.status_view = view
+        if view is None:
+            return
+        if running or pending:
+            view.set_status('spandoc_jobs', "Spandoc: " + str(running) + " running, " + str(pending) + " queued")
         else:
-            use_pp = transformation['use_pp']
-        debug("use_pp: " + str(use_pp))
+            view.erase_status('spandoc_jobs')
 
-        if use_pp is True:
-            # this pandoc_cmd is the command, which will be later passed to pp
-            # it is first constructed as a normal python list and then converted into a connected string
-            pp_cmd = ['pp']
 
-            # use the output extension as a symbol (for referencing)
-            pp_cmd.extend(['-D', output_extension])
+def get_job_key(conversion):
+    '''Return the key by which jobs of identical conversions are coalesced: the input
+    (file or view), the state of its content, the transformation and the pandoc command.
 
-            # append the name of the source file on which pp will be run
-            pp_cmd.extend([file_name_with_ext])
+    The content of a view is hashed; a file is identified by its mtime and size,
+    so submitting a job (on the main thread) never reads a large file.'''
+
+    if conversion.contents is not None:
+        if conversion.view is None:
+            return None
+        source = 'view:' + str(conversion.view.id())
+        content = hashlib.sha1(conversion.contents).hexdigest()
+    else:
+        source = conversion.input_path()
+        content = get_file_stamp(source) if source is not None else None
+        if content is None:
+            return None
+    return (source, content, conversion.name, tuple(conversion.pandoc_cmd), conversion.output_name)
 
-            # the result will be written to an intermediate file with this constructed name:
-            pp_file_name_with_ext = str(file_name)+str("_pp_")+str(output_extension)+str(input_extension)
-            pp_cmd.extend(['>', pp_file_name_with_ext])
 
-            pp_cmd = ' '.join(pp_cmd)
+class SpandocCancelAllCommand(sublime_plugin.WindowCommand):
 
-            debug("pp_cmd: " + str(pp_cmd))
+    '''Cancels all pending and running Spandoc jobs, killing their processes.'''
 
-            process_pp = subprocess.Popen(pp_cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=folder_path)
+    def run(self):
+        cancelled = get_scheduler().cancel_all()
+        sublime.status_message("Spandoc: cancelled " + str(cancelled) + " jobs")
 
-            # now use the outputted file from pp for use in pandoc!:
 
+class SpandocLivePreviewCommand(sublime_plugin.WindowCommand):
 
-        # this pandoc_cmd is the command, which will be later passed to pandoc
-        # it is first constructed as a normal python list and then converted into a connected string
-        # the pandoc_cmd will be outputted to the console and should be used in the CLI as normal
-        pandoc_cmd = [pandoc_path]
+    '''Toggles the live preview of the current view: after every pause in typing
+    ("live_preview_delay" ms), the view is converted with the transformation of
+    the "live_preview_transformation" setting (or the "transformation" argument).'''
+
+    def run(self, transformation=None):
+        view = self.window.active_view()
+        if view is None:
+            return
+        if view.id() in live_previews:
+            live_previews.pop(view.id()).stop()
+            sublime.status_message("Spandoc: live preview off")
+            return
+
+        if transformation is None:
+            unused_view, folder_path, unused_file_name = get_current(self.window)
+            settings = get_settings(view, folder_path)
+            if settings is None:
+                return
+            transformation = settings.get('live_preview_transformation', 'HTML')
+
+        preview = live_previews[view.id()] = LivePreview(self.window, view, transformation)
+        sublime.status_message("Spandoc: live preview on (" + transformation + ")")
+        sublime.set_timeout_async(lambda: preview.update(preview.generation), 0)
+
+
+class SpandocLivePreviewListener(sublime_plugin.EventListener):
+
+    '''Triggers the live previews on modifications of their views.'''
+
+    def on_modified_async(self, view):
+        preview = live_previews.get(view.id())
+        if preview is not None:
+            preview.modified()
+
+    def on_close(self, view):
+        preview = live_previews.pop(view.id(), None)
+        if preview is not None:
+            preview.stop()
+
+
+class LivePreview(object):
+
+    '''The live preview of one view.
+
+    Every modification cancels the running conversion (killing its processes)
+    and schedules a new one after the debounce delay; a conversion only starts
+    if no newer modification came in meanwhile. So at most one conversion per
+    view is running, no matter how fast the view changes.'''
+
+    def __init__(self, window, view, transformation):
+        self.window = window
+        self.view = view
+        self.transformation = transformation
+        self.runner = SpandocRunCommand(window)
+        self.generation = 0
+        self.conversion = None
+        self.preview_view = None
+        self.lock = threading.Lock()
+
+    def modified(self):
+        with self.lock:
+            self.generation += 1
+            generation = self.generation
+            running = self.conversion
+        if running is not None:
+            running.cancel()
+        delay = get_package_settings().get('live_preview_delay', 500)
+        sublime.set_timeout_async(lambda: self.update(generation), delay)
+
+    def update(self, generation):
+        if generation != self.generation or not self.view.is_valid():
+            # a newer modification is pending, or the preview was stopped
+            return
+
+        view, folder_path, file_name = self.view, None, self.view.file_name()
+        if file_name:
+            folder_path, file_name = os.path.split(file_name)
+        elif self.window.folders():
+            folder_path = self.window.folders()[0]
+        settings = get_settings(view, folder_path)
+        if settings is None or self.transformation not in settings['transformations']:
+            sublime.status_message("Spandoc: no transformation " + self.transformation + " for the live preview")
+            return
+        try:
+            conversion = prepare_conversion(self.window, view, folder_path, file_name, settings, self.transformation, read_buffer=True)
+        except ConversionError as e:
+            sublime.status_message("Spandoc live preview: " + str(e).splitlines()[0])
+            return
+
+        with self.lock:
+            if generation != self.generation:
+                return
+            if self.conversion is not None:
+                self.conversion.cancel()
+            self.conversion = conversion
+        # not on the async thread, which has to stay free to cancel it
+        get_scheduler().submit(lambda: self.convert(conversion), PRIORITY_ACTIVE, conversion)
+
+    def convert(self, conversion):
+        try:
+            result = self.runner.convert(conversion)
+        except ConversionCancelled:
+            return
+        except ConversionError as e:
+            sublime.status_message("Spandoc live preview: " + str(e).splitlines()[0])
+            return
+        finally:
+            with self.lock:
+                if self.conversion is conversion:
+                    self.conversion = None
+
+        if conversion.output_name is None:
+            # the preview buffer is reused for every update
+            text = result.decode('utf-8').replace('\r\n', '\n')
+            sublime.set_timeout(lambda: self.show(text, conversion.transformation), 0)
+        sublime.status_message("Spandoc: live preview updated")
+
+    def show(self, text, transformation):
+        if self.preview_view is None or not self.preview_view.is_valid():
+            self.preview_view = self.window.new_file()
+            self.preview_view.set_scratch(True)
+            self.preview_view.set_name("Spandoc Preview")
+            self.window.focus_view(self.view)
+            syntax_file = transformation.get('syntax_file')
+            if syntax_file:
+                self.preview_view.set_syntax_file(syntax_file)
+        self.preview_view.run_command('spandoc_replace_content', {'text': text})
+
+    def stop(self):
+        with self.lock:
+            self.generation += 1
+            running, self.conversion = self.conversion, None
+        if running is not None:
+            running.cancel()
+
+
+class SpandocBuildProjectCommand(SpandocRunCommand):
+
+    '''Converts all files of the project with the transformations of the "build" setting,
+    rebuilding only outputs which are out of date.
+
+    An output is out of date, when it is older than its source, its settings
+    file, the files named in its pandoc-arguments (templates, CSS,
+    bibliographies, ...) or the files included by pp. These dependencies are
+    kept in a manifest, so checking an unchanged project only needs a stat()
+    of every dependency.'''
+
+    def run(self, transformations=None, force=False):
+        view = self.window.active_view()
+        folders = self.window.folders()
+        if not folders:
+            sublime.error_message('Spandoc: The build needs a project with folders.')
+            return
+        sublime.status_message("Spandoc: checking the project ...")
+        sublime.set_timeout_async(lambda: self.build(view, folders, transformations, force), 0)
+
+
+    def build(self, view, folders, transformations, force):
+
+        started = time.time()
+        # this runs in the background, so the settings files are looked up in the complete indexes
+        for folder in folders:
+            get_folder_settings_index(folder).ready.wait()
+        manifest = BuildManifest(get_build_manifest_path(folders))
+        sources = [(source, self.get_build_conversions(source, transformations))
+                   for source in find_build_sources(self.window, folders, get_package_settings().get('folder_settings_ignore', ()))]
+
+        # outputs of this build (or of earlier builds) are no sources, e.g. a.html of a.md is not converted to a.pdf
+        outputs = set(os.path.normpath(path) for path in manifest.entries)
+        outputs.update(os.path.normpath(conversion.output_path()) for unused_source, conversions in sources for conversion in conversions)
+        conversions_by_output = OrderedDict()
+        for source, conversions in sources:
+            if os.path.normpath(source.path) in outputs:
+                continue
+            for conversion in conversions:
+                conversions_by_output.setdefault(os.path.normpath(conversion.output_path()), []).append(conversion)
+
+        # conversions writing the same output would overwrite each other (and its manifest entry), they are skipped
+        collisions = [(output_path, conversions) for output_path, conversions in conversions_by_output.items() if len(conversions) > 1]
+        if collisions:
+            lines = ["Spandoc: Build Project: these outputs are written by several conversions, they are not built:", ""]
+            for output_path, conversions in collisions:
+                lines.append(output_path)
+                lines.extend("    " + conversion.name + ": " + conversion.input_path() for conversion in conversions)
+            text = '\n'.join(lines)
+            sublime.set_timeout(lambda: show_panel(self.window, text), 0)
+
+        targets = []
+        for conversions in conversions_by_output.values():
+            if len(conversions) > 1:
+                continue
+            conversion = conversions[0]
+            dependencies = manifest.get_dependencies(conversion)
+            if force or manifest.is_stale(conversion, dependencies):
+                targets.append((conversion, dependencies))
+        debug("build: " + str(len(targets)) + " outputs to rebuild, checked in " + str(round(time.time() - started, 3)) + "s")
+
+        if not targets:
+            manifest.save()
+            sublime.status_message("Spandoc: all outputs are up to date")
+            return
+
+        progress = BatchProgress(self.window, view, len(targets), on_finish=manifest.save)
+        for conversion, dependencies in targets:
+            name = conversion.name + ": " + conversion.file_name
+            get_scheduler().submit(partial(self.run_build_conversion, conversion, dependencies, manifest, progress), PRIORITY_BATCH, conversion,
+                on_cancel=partial(progress.done, name, 'Cancelled'))
+
+
+    def get_build_conversions(self, source, transformations):
+        '''Return the conversions of one source file (a ScopedFile).'''
+
+        folder_path, file_name = os.path.split(source.path)
+        settings = get_settings(source, folder_path)
+        if settings is None:
+            return []
+        names = transformations if transformations is not None else settings.get('build', ())
+
+        conversions = []
+        for name in rank_transformations(settings, source):
+            transformation = settings['transformations'][name]
+            if name not in names or transformation.get('buffer') is True:
+                continue
+            try:
+                conversion = prepare_conversion(self.window, source, folder_path, file_name, settings, name)
+            except ConversionError as e:
+                debug("build: skipping " + name + " of " + source.path + ": " + str(e))
+                continue
+            conversion.settings_file = search_for_folder_settings_file("spandoc.json", folder_path, self.window)
+            conversions.append(conversion)
+        return conversions
+
+
+    def run_build_conversion(self, conversion, dependencies, manifest, progress):
+
+        name = conversion.name + ": " + conversion.file_name
+        try:
+            self.convert(conversion)
+        except ConversionError as e:
+            progress.done(name, str(e))
+            return
+        except Exception as e:
+            traceback.print_exc()
+            progress.done(name, 'Unexpected error: ' + repr(e))
+            return
+        manifest.record(conversion, dependencies)
+        progress.done(name)
+
+
+class ScopedFile(object):
+
+    '''A file which is not open in a view, with the parts of the view API used to
+    rank transformations and to prepare conversions.'''
+
+    def __init__(self, window, path, scope):
+        self.path = path
+        self.scope = scope
+        self._window = window
+
+    def window(self):
+        return self._window
+
+    def file_name(self):
+        return self.path
+
+    def scope_name(self, point):
+        return self.scope
 
-        # append the file name to the pandoc command
-        if use_pp is True:
-            pandoc_cmd.extend([pp_file_name_with_ext])
-        else:
-            pandoc_cmd.extend([file_name_with_ext])
 
+class BuildManifest(object):
 
-        # add the pandoc's `--from` parameter to the pandocs command
-        pandoc_cmd.extend(['-f', input_format])
+    '''The dependencies of the outputs built by SpandocBuildProjectCommand, persisted as JSON:
+    {output path: {"command": pandoc command, "stamps": {dependency or output path: [mtime, size]}}}'''
 
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path, 'r') as manifest_file:
+                self.entries = json.load(manifest_file)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def get_dependencies(self, conversion):
+        '''Return the files an output depends on, reusing the recorded ones while they are unchanged.'''
+
+        entry = self.entries.get(conversion.output_path())
+        if entry is not None and entry.get('command') == conversion.pandoc_cmd and self.is_unchanged(entry['stamps']):
+            return [path for path in entry['stamps'] if path != conversion.output_path()]
+        return get_build_dependencies(conversion)
+
+    def is_unchanged(self, stamps):
+        for path, stamp in stamps.items():
+            current = get_file_stamp(path)
+            if current is None and stamp is None:
+                continue
+            if current is None or stamp is None or list(current) != list(stamp):
+                return False
+        return True
+
+    def is_stale(self, conversion, dependencies):
+        output_path = conversion.output_path()
+        entry = self.entries.get(output_path)
+        if entry is not None and entry.get('command') == conversion.pandoc_cmd and self.is_unchanged(entry['stamps']):
+            return False
+
+        output_stamp = get_file_stamp(output_path)
+        if output_stamp is None:
+            return True
+        if entry is not None and entry.get('command') != conversion.pandoc_cmd:
+            return True
+        for path in dependencies:
+            stamp = get_file_stamp(path)
+            if stamp is not None and stamp[0] > output_stamp[0]:
+                return True
+
+        # up to date, remember it for the next build
+        self.record(conversion, dependencies)
+        return False
+
+    def record(self, conversion, dependencies):
+        stamps = dict((path, get_file_stamp(path)) for path in dependencies)
+        stamps[conversion.output_path()] = get_file_stamp(conversion.output_path())
+        with self.lock:
+            self.entries[conversion.output_path()] = {'command': conversion.pandoc_cmd, 'stamps': stamps}
+
+    def save(self):
+        with self.lock:
+            data = json.dumps(self.entries)
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + '.tmp', 'w') as manifest_file:
+                manifest_file.write(data)
+            os.replace(self.path + '.tmp', self.path)
+        except OSError as e:
+            debug("Could not write the build manifest: " + str(e))
+
+
+def get_build_manifest_path(folders):
+
+    key = hashlib.sha1('\n'.join(sorted(folders)).encode('utf-8')).hexdigest()
+    return os.path.join(sublime.cache_path(), 'Spandoc', 'build', key + '.json')
+
+
+def find_build_sources(window, folders, ignore):
+    '''Yield a ScopedFile for every file in the project folders, which has a known syntax.'''
+
+    for folder in folders:
+        for root, dirs, files in os.walk(folder):
+            dirs[:] = [name for name in dirs if not any(fnmatch.fnmatch(name, pattern) for pattern in ignore)]
+            for name in files:
+                path = os.path.join(root, name)
+                scope = get_file_scope(path)
+                if scope:
+                    yield ScopedFile(window, path, scope)
+
+
+def get_file_scope(path):
+    '''Return the base scope of the syntax Sublime would use for a file.'''
+
+    extension = os.path.splitext(path)[1].lower()
+    if extension in BUILD_SCOPES:
+        return BUILD_SCOPES[extension]
+    if hasattr(sublime, 'find_syntax_for_file') and extension:
+        # Sublime Text 4 only
+        syntax = sublime.find_syntax_for_file(path)
+        if syntax is not None and syntax.scope.startswith('text.'):
+            return syntax.scope
+    return None
+
+
+def get_build_dependencies(conversion):
+    '''Return the files an output depends on: source, settings files, files named in the arguments and pp includes.'''
+
+    folder_path = conversion.folder_path
+    dependencies = [conversion.input_path()]
+    if conversion.settings_file:
+        dependencies.append(conversion.settings_file)
+    else:
+        dependencies.append(os.path.join(sublime.packages_path(), 'User', SETTINGS_FILE))
+    for file_name in get_argument_files(conversion.pandoc_arguments):
+        dependencies.append(os.path.join(folder_path, os.path.expanduser(file_name)))
+    if conversion.preprocessors:
+        dependencies.extend(get_pp_includes(conversion.input_path()))
+
+    unique = []
+    for path in dependencies:
+        path = os.path.normpath(path)
+        if path not in unique:
+            unique.append(path)
+    return unique
+
+
+def get_pp_includes(file_path, seen=None):
+    '''Return the files included by pp macros (!include, !import, ...) in a file, recursively.'''
+
+    if seen is None:
+        seen = set([os.path.normpath(file_path)])
+    try:
+        with open(file_path, 'r', encoding='utf-8', errors='replace') as source:
+            text = source.read()
+    except OSError:
+        return []
+
+    includes = []
+    for match in PP_INCLUDE_PATTERN.finditer(text):
+        path = os.path.normpath(os.path.join(os.path.dirname(file_path), os.path.expanduser(match.group(1))))
+        if path in seen:
+            continue
+        seen.add(path)
+        includes.append(path)
+        includes.extend(get_pp_includes(path, seen))
+    return includes
+
+
+def rank_transformations(settings, view):
+    '''Return the names of the transformations available for a view, best matching first.'''
+
+    return list(settings.rank(view.scope_name(0)))
+
+
+def get_scheduler():
+    '''Return the job scheduler, running as many jobs at once as the "max_jobs" setting allows.'''
+
+    global scheduler
+    max_jobs = get_package_settings().get('max_jobs') or multiprocessing.cpu_count()
+    with scheduler_lock:
+        if scheduler is None:
+            scheduler = JobScheduler(max_jobs)
+        scheduler.max_jobs = max_jobs
+        return scheduler
+
+
+def prepare_conversion(window, view, folder_path, file_name_with_ext, settings, name, read_buffer=False):
+    '''Assemble the Conversion of a view with the transformation "name" (raises ConversionError).
+
+    With read_buffer, the input is the content of the view instead of its file,
+    like in buffer mode (used by the live preview).'''
+
+    # gets pandoc executable from settings
+    pandoc_path = find_pandoc(settings.get('pandoc_path'))
+    if pandoc_path is None:
+        raise ConversionError('Could not find pandoc executable. Do you have set the "pandoc_path" parameter in the settings? (' + repr(settings.get('pandoc_path')) + ')')
+    # debug("pandoc_path: " + str(pandoc_path))
+
+    # get all the items from picked transformation out of the settings
+    transformation = settings['transformations'][name]
+    # debug("transformations: " + str(transformation))
+
+    # write the result to a buffer instead of a file? The input is then the (maybe unsaved) content of the view
+    buffer_mode = transformation.get('buffer') is True
+    if file_name_with_ext is None and not buffer_mode:
+        raise ConversionError('Spandoc: Please save the file first. Only transformations with `"buffer": true` can convert unsaved files.')
+    read_buffer = read_buffer or buffer_mode
+
+    # the pandoc arguments are parsed once, when the settings are loaded; this is a copy to add to
+    pandoc_arguments = settings.arguments[name].copy()
+    # a single `--output` only marks writing to a file, it is not passed to pandoc
+    if pandoc_arguments.get('output') is True:
+        pandoc_arguments.remove('output')
+    # debug("pandoc_arguments: " + str(pandoc_arguments))
+
+
+    # output_format / `--to` parameter
+    output_format = pandoc_arguments.get('to')
+    if output_format is None or output_format is True:
+        raise ConversionError('Could not find Pandocs `--to` argument. Do you have set the `--to` argument inside the `pandoc-arguments` array in the settings?')
+    # debug("output_format: " + str(output_format))
+
+    # input_format / `--from` parameter, of the best matching scope
+    input_format = settings.rank(view.scope_name(0)).get(name)
+    if input_format is None:
+        raise ConversionError('Could not find Pandocs `--from` argument. Do you have set the scopes dictionary in the settings, with a scope matching the syntax of the file?')
+    # debug("input_format: " + str(input_format))
+
+    # check the formats, if this pandoc has been probed already (by warm_up), to report a typo before pandoc runs
+    with pandoc_versions_lock:
+        formats = pandoc_formats.get(pandoc_path)
+    if formats:
+        for kind, format_name, known in (('input', input_format, formats[0]), ('output', output_format, formats[1])):
+            base_name = FORMAT_EXTENSION_PATTERN.split(format_name, 1)[0]
+            # custom readers/writers are files (e.g. writer.lua)
+            if base_name not in known and '.' not in base_name:
+                raise ConversionError('Pandoc does not know the ' + kind + ' format "' + base_name + '" of the transformation "' + name + '".')
+
+
+    # Display Result in Buffer or write to a file?
+    if buffer_mode:
+        # the result is read from stdout
+        pandoc_arguments.remove('output')
+        output_name = None
+    else:
+        output_name = pandoc_arguments.get('output')
+
+        # The output file will have the same name as the input file, unless otherwise specified with the `--output` option.
+        if output_name is None:
+            output_name, unused_input_extension = os.path.splitext(file_name_with_ext)
+
+
+    # use output_extension as specified in the output_extension parameter,
+    # if it is not specified or blank, use output_format as from the file output_extension,
+    output_extension = transformation.get('output_extension') or output_format
+    # debug("output_extension: " + str(output_extension))
+
+
+    # add the output_extension to the name
+    output_name_with_ext = None
+    if output_name is not None:
+        output_name_with_ext = output_name + "." + output_extension
+    # debug("output_name_with_ext: " + str(output_name_with_ext))
+
+
+    # Optional: pipe the source through a chain of preprocessors before executing pandoc, e.g. pp, see: http://cdsoft.fr/pp/
+    # pp is activated with the `use_pp=true` keyword in the settings, any other with the `preprocessors` list.
+    # When the buffer is the input, it is passed on stdin and `$file` is "-" (stdin), not the saved file:
+    preprocessors, source_on_stdin = get_preprocessors(transformation, {
+        'file': '-' if read_buffer else file_name_with_ext or '',
+        'folder': folder_path or '',
+        'input_format': input_format,
+        'output_format': output_format,
+        'output_extension': output_extension,
+    })
+    debug("preprocessors: " + str(preprocessors))
+    preprocessor_input = file_name_with_ext if source_on_stdin and not read_buffer else None
 
-        # add the output_name_with_ext to the pandoc command
-        pandoc_arguments.extend(['-o', output_name_with_ext])
 
-        # add all other pandoc arguments to the pandoc command!
-        pandoc_cmd.extend(pandoc_arguments)
+    # this pandoc_cmd is the command, which will be later passed to pandoc
+    # it is constructed as a list of arguments and executed without a shell, so any file name is safe
+    # the pandoc_cmd will be outputted to the console (quoted) and can be used in the CLI as normal
+    pandoc_cmd = [pandoc_path]
 
-        # this section is for the buffer functionality, not yet implemented!
-        # string to work with (gets the whole file as text in buffer; selects the whole file)
+    # append the file name to the pandoc command, preprocessed input and the buffer content are read from stdin
+    if not preprocessors and not read_buffer:
+        pandoc_cmd.extend([file_name_with_ext])
+
+
+    # add the pandoc's `--from` parameter to the pandocs command
+    pandoc_cmd.extend(['-f', input_format])
+
+
+    # add the output_name_with_ext to the pandoc command
+    if output_name_with_ext is not None:
+        pandoc_arguments.set('output', output_name_with_ext)
+
+    # add all other pandoc arguments to the pandoc command!
+    pandoc_cmd.extend(pandoc_arguments.as_list())
+
+    # in buffer mode, the whole content of the view is the input (encoded once, passed to stdin)
+    contents = None
+    if read_buffer:
         region = sublime.Region(0, view.size())
         # debug("region: " + str(region))
-        contents = view.substr(region)
-        # debug("contents: " + str(contents))
+        contents = view.substr(region).encode('utf-8')
+
+    # Optional: convert with a long-lived `pandoc server` instead of starting pandoc for every conversion
+    # this is activated with `"pandoc_backend": "server"` in the settings; conversions the server can not
+    # handle (preprocessors, options without a server equivalent) run pandoc on the command line
+    # PDFs are made by pandoc from the LaTeX output, which only the command line does
+    server_params = None
+    if settings.get('pandoc_backend') == 'server' and not preprocessors and output_extension != 'pdf':
+        server_params = get_server_params(pandoc_arguments, input_format)
+        debug("server_params: " + str(server_params))
+        if server_params is None:
+            debug("The pandoc server does not support all pandoc_arguments, using the command line")
+
+    # write pandoc command to console
+    debug("pandoc_cmd: " + format_command(pandoc_cmd))
+
+    return Conversion(name, window, transformation, settings, view, folder_path, file_name_with_ext, pandoc_cmd, input_format, output_format,
+        output_name=output_name_with_ext, preprocessors=preprocessors, preprocessor_input=preprocessor_input, contents=contents, server_params=server_params,
+        pandoc_arguments=pandoc_arguments)
+
+
+
+class ConversionError(Exception):
+
+    '''A conversion could not be prepared or has failed; the message is shown to the user.'''
+
+
+class ConversionCancelled(ConversionError):
+
+    '''A conversion was cancelled (its processes killed) before it finished.'''
+
+    def __init__(self, message='Cancelled'):
+        super().__init__(message)
+
+
+class Conversion(object):
+
+    '''One transformation of one document, as assembled by SpandocRunCommand.run.
+
+    pandoc_cmd is the full pandoc command as a list, pandoc_arguments (a
+    PandocArguments) its part after the input file and the `-f` argument. output_name is the output
+    file (relative to folder_path), None when the result goes to a buffer.
+    contents is the encoded buffer content, when it is the input.'''
+
+    def __init__(self, name, window, transformation, settings, view, folder_path, file_name, pandoc_cmd, input_format, output_format,
+                 output_name=None, preprocessors=(), preprocessor_input=None, contents=None, server_params=None, pandoc_arguments=None):
+        self.name = name
+        self.window = window
+        self.transformation = transformation
+        self.settings = settings
+        self.view = view
+        self.folder_path = folder_path
+        self.file_name = file_name
+        self.pandoc_cmd = pandoc_cmd
+        self.input_format = input_format
+        self.output_format = output_format
+        self.output_name = output_name
+        self.preprocessors = preprocessors
+        self.preprocessor_input = preprocessor_input
+        self.contents = contents
+        self.server_params = server_params
+        # the arguments of pandoc_cmd after the input file and format
+        self.pandoc_arguments = pandoc_arguments if pandoc_arguments is not None else PandocArguments()
+        # the folder settings file the settings came from, set by the project build
+        self.settings_file = None
+        # the number of pandoc runs which wrote warnings (stderr, but no error code)
+        self.warnings = 0
+        # the timing of the conversion, replaced by SpandocRunCommand to include its stages
+        self.timing = Timing('run', name, file_name)
+        # the processes started for the conversion, killed by cancel()
+        self.processes = []
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    def started(self, process):
+        with self.lock:
+            self.processes.append(process)
+            cancelled = self.cancelled
+        if cancelled:
+            kill(process)
+
+    def cancel(self):
+        '''Kill the running processes of the conversion; it then raises ConversionCancelled.'''
+        with self.lock:
+            self.cancelled = True
+            processes = list(self.processes)
+        for process in processes:
+            kill(process)
+
+    def output_path(self):
+        if self.output_name is None:
+            return None
+        return os.path.join(self.folder_path or '', self.output_name)
 
-        # join the list of commands to one (string) command
-        pandoc_cmd = ' '.join(pandoc_cmd)
-        # write pandoc command to console
-        debug("pandoc_cmd: " + str(pandoc_cmd))
+    def input_path(self):
+        if self.file_name is None:
+            return None
+        return os.path.join(self.folder_path or '', self.file_name)
 
-        if use_pp is True:
-            # execute pandoc only when pp is finished
-            process_pp.communicate()
+    def read_input(self):
+        '''Return the input as bytes: the buffer content or the content of the input file.'''
+        if self.contents is not None:
+            return self.contents
+        try:
+            with open(self.input_path(), 'rb') as input_file:
+                return input_file.read()
+        except (OSError, TypeError) as e:
+            raise ConversionError('Could not read ' + str(self.file_name) + ': ' + str(e))
+
+
+class PandocErrors(object):
+
+    '''Reads the stderr of a pandoc process in a background thread, as it arrives,
+    into the pandoc output panel of the window of the conversion.
+
+    Only the last ERROR_TAIL_SIZE bytes are kept, for the error message.'''
+
+    def __init__(self, stream, conversion, pandoc_cmd):
+        self.stream = stream
+        self.window = conversion.window
+        self.title = get_pandoc_panel_title(conversion)
+        self.tail = b''
+        self.size = 0
+        self.thread = threading.Thread(target=self.read, daemon=True)
+        self.thread.start()
+
+    def read(self):
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        for chunk in iter(lambda: self.stream.read1(8192), b''):
+            if not self.size:
+                self.show(self.title)
+            self.size += len(chunk)
+            self.tail = (self.tail + chunk)[-ERROR_TAIL_SIZE:]
+            self.show(decoder.decode(chunk).replace('\r\n', '\n'))
+        self.stream.close()
+
+    def show(self, text):
+        if self.window is not None and text:
+            sublime.set_timeout(lambda: append_to_pandoc_panel(self.window, text), 0)
+
+    def join(self):
+        self.thread.join()
+
+    def text(self):
+        return self.tail.decode('utf-8', 'replace').strip()
+
+
+class BufferWriter(object):
+
+    '''Writes the output of a buffer conversion into a new buffer in chunks, as pandoc
+    writes it, so a large output is never held as a whole by the plugin.
+
+    The new buffer is opened when the first chunk arrives. Results replacing the
+    converted view are not streamed, see get_buffer_writer.'''
+
+    def __init__(self, conversion):
+        self.window = conversion.window
+        self.transformation = conversion.transformation
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        # a "\r" at the end of a chunk, which may start a "\r\n"
+        self.carriage_return = False
+        self.target = None
+        self.size = 0
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        self.send(self.decoder.decode(chunk))
+
+    def close(self):
+        self.send(self.decoder.decode(b'', True), True)
+
+    def send(self, text, final=False):
+        if self.carriage_return:
+            text = '\r' + text
+        self.carriage_return = not final and text.endswith('\r')
+        if self.carriage_return:
+            text = text[:-1]
+        text = text.replace('\r\n', '\n')
+        if text or final:
+            sublime.set_timeout(lambda: self.append(text), 0)
+
+    def append(self, text):
+        if self.target is None:
+            self.target = self.window.new_file()
+            syntax_file = self.transformation.get('syntax_file')
+            if syntax_file:
+                self.target.set_syntax_file(syntax_file)
+        if text:
+            self.target.run_command('append', {'characters': text, 'force': True, 'scroll_to_end': False})
+
+
+def get_buffer_writer(conversion):
+    '''Return the BufferWriter of a conversion into a new buffer, None otherwise.
+
+    A result replacing the converted view (`"new-buffer": false`) is written by
+    write_to_buffer once pandoc has succeeded, so a failed or cancelled conversion
+    leaves the view untouched.'''
+
+    if conversion.output_name is not None:
+        return None
+    if not conversion.transformation.get('new-buffer', True) and conversion.view is not None:
+        return None
+    return BufferWriter(conversion)
 
-        # Pass the pandoc_cmd to Pandoc and run Pandoc in async mode
-        sublime.set_timeout_async(lambda: self.pass_to_pandoc(pandoc_cmd, folder_path, output_format, transformation, output_name_with_ext), 0)
 
+class Timing(object):
 
-    def pass_to_pandoc(self, pandoc_cmd, folder_path, output_format, transformation, output_name):
+    '''The durations of the stages of one command (e.g. "discovery" of the folder
+    settings file, "settings", "prepare", "startup" and runtime of "pandoc") and
+    the sizes of its output and error output.
 
-        process = subprocess.Popen(pandoc_cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=folder_path)
+    record() adds it to the timings (a ring buffer shown by SpandocStatsCommand)
+    and appends it as a JSON line to the "timing_log" file, if one is set.'''
 
-        # Next line always waits for the output (buffering) but this is not a problem (no locking here) because this is in async mode (new thread)
-        # if there is an result pandoc has put the conversion in stdout, when result is empty it has written to a file
-        result, error = process.communicate()
-        # result, error = process.communicate(contents.encode('utf-8'))
+    def __init__(self, command, transformation=None, file_name=None):
+        self.command = command
+        self.transformation = transformation
+        self.file_name = file_name
+        self.started = time.time()
+        # {stage: seconds}, stages running several times (e.g. pandoc for the AST cache) are summed
+        self.stages = OrderedDict()
+        self.counts = {'output_bytes': 0, 'error_bytes': 0}
+        self.lock = threading.Lock()
 
-        # Handle Pandoc errors
-        if error:
-            sublime.error_message('\n\n'.join(['Error when running:', ''.join(pandoc_cmd), error.decode('utf-8').strip()]))
+    @contextlib.contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                self.stages[stage] = self.stages.get(stage, 0) + seconds
+
+    def count(self, name, value):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def count_output(self, conversion, result):
+        if conversion.output_name is None:
+            size = len(result)
+        else:
+            try:
+                size = os.path.getsize(conversion.output_path())
+            except OSError:
+                size = 0
+        with self.lock:
+            self.counts['output_bytes'] = size
+
+    def record(self, settings, outcome='ok'):
+        with self.lock:
+            entry = OrderedDict([
+                ('time', round(self.started, 3)),
+                ('command', self.command),
+                ('transformation', self.transformation),
+                ('file', self.file_name),
+                ('outcome', outcome),
+                ('total', round(time.time() - self.started, 6)),
+                ('stages', OrderedDict((stage, round(seconds, 6)) for stage, seconds in self.stages.items())),
+            ])
+            entry.update(sorted(self.counts.items()))
+        with timings_lock:
+            timings.append(entry)
+            log_file = settings.get('timing_log') if settings is not None else None
+            if log_file:
+                try:
+                    with open(os.path.expanduser(log_file), 'a', encoding='utf-8') as log:
+                        log.write(json.dumps(entry) + '\n')
+                except OSError as e:
+                    debug("Could not write the timing log: " + str(e))
+
+
+class SpandocWorkerCommand(sublime_plugin.WindowCommand):
+
+    '''Shows the health of the worker process ("pandoc_backend": "worker") in an output
+    panel, or stops it (action "stop"). The worker is not started by this command.'''
+
+    def run(self, action="health"):
+        sublime.set_timeout_async(lambda: self.run_async(action), 0)
+
+    def run_async(self, action):
+        if not hasattr(socket, 'AF_UNIX'):
+            sublime.status_message("Spandoc: the worker needs Unix domain sockets, which are not available here")
+            return
+        worker = SpandocWorker(get_package_settings())
+        try:
+            response = worker.request({'command': 'shutdown' if action == "stop" else 'health'}, start=False, timeout=5)
+        except WorkerUnavailable:
+            sublime.status_message("Spandoc: the worker is not running")
+            return
+        if action == "stop":
+            sublime.status_message("Spandoc: worker stopped")
             return
 
+        lines = ["Spandoc worker: " + ("healthy" if response.get('ok') else "not healthy: " + str(response.get('error'))), ""]
+        for name in ('pid', 'python', 'socket', 'uptime', 'idle', 'idle_timeout', 'jobs', 'running', 'requests', 'conversions', 'cache_hits', 'shared', 'cancelled', 'cache_entries'):
+            if name in response:
+                lines.append("  " + name.ljust(14) + str(response[name]))
+        if 'cache_size' in response:
+            lines.append("  " + "cache_size".ljust(14) + format_size(response['cache_size']))
+        for pandoc_path, version in sorted((response.get('pandoc') or {}).items()):
+            lines.append("  " + "pandoc".ljust(14) + pandoc_path + ": " + str(version))
+        show_panel(self.window, '\n'.join(lines))
 
-        # if write to file, open
-        # if output_format is not None and output_format in get_settings('pandoc-format-file'):
-        #     try:
-        #         if sublime.platform() == 'osx':
-        #             subprocess.call(["open", output_name])
-        #         elif sublime.platform() == 'windows':
-        #             os.startfile(output_name)
-        #         elif os.name == 'posix':
-        #             subprocess.call(('xdg-open', output_name))
-        #     except:
-        #         sublime.message_dialog('Wrote to file ' + output_name)
-        #     return
 
-        # write to buffer
-        # if result:
-        #     if transformation['new-buffer']:
-        #         w = self.view.window()
-        #         w.new_file()
-        #         view = w.active_view()
-        #         region = sublime.Region(0, view.size())
-        #     else:
-        #         view = self.view
-        #         region = sublime.Region(0, view.size())
+class SpandocStatsCommand(sublime_plugin.WindowCommand):
 
-        #     with Edit(view) as edit:
-        #         edit.replace(region, result.decode('utf8').replace('\r\n','\n'))
+    '''Shows the latencies (p50/p95, in total and per stage) of the last conversions
+    per transformation in an output panel, or clears them (action "clear").'''
 
-        #     view.set_syntax_file(transformation['syntax_file'])
+    def run(self, action="show"):
+        with timings_lock:
+            if action == "clear":
+                timings.clear()
+                sublime.status_message("Spandoc: timings cleared")
+                return
+            entries = list(timings)
 
-        # Output Status message done:
-        sublime.status_message("Spandoc DONE")
+        if not entries:
+            sublime.status_message("Spandoc: no conversions timed yet")
+            return
 
+        groups = OrderedDict()
+        for entry in entries:
+            label = entry['transformation'] if entry['command'] != 'palette' else '(palette)'
+            groups.setdefault(label, []).append(entry)
+
+        lines = ["Spandoc timings of the last " + str(len(entries)) + " commands (p50 / p95)", ""]
+        for label, group in sorted(groups.items(), key=lambda item: str(item[0])):
+            failed = sum(1 for entry in group if entry['outcome'] == 'error')
+            lines.append(str(label) + ": " + str(len(group)) + " runs" + (", " + str(failed) + " failed" if failed else ""))
+            lines.append(format_percentiles("total", [entry['total'] for entry in group]))
+            stages = OrderedDict()
+            for entry in group:
+                for stage, seconds in entry['stages'].items():
+                    stages.setdefault(stage, []).append(seconds)
+            for stage, values in stages.items():
+                lines.append(format_percentiles(stage, values))
+            for name in ('output_bytes', 'error_bytes'):
+                values = sorted(entry.get(name, 0) for entry in group)
+                if values[-1]:
+                    lines.append("  " + name.ljust(14) + format_size(percentile(values, 0.5)).rjust(10) + " / " + format_size(percentile(values, 0.95)))
+            lines.append("")
+        show_panel(self.window, '\n'.join(lines))
+
+
+class SpandocReplaceContentCommand(sublime_plugin.TextCommand):
+
+    '''Internal command: replaces the whole content of a view with a conversion result.'''
+
+    def run(self, edit, text):
+        self.view.replace(edit, sublime.Region(0, self.view.size()), text)
+
+
+class PandocArguments(object):
+
+    '''Parsed pandoc arguments.
+
+    Both forms are understood, "short" form: "-k val" (or "-kval") and "long"
+    form: "--key=val" (or "--key val"). Options are normalized to their long
+    name (e.g. "-t" and "--write" to "to"), so get/remove/set are dict
+    lookups. as_list() renders them back as "--key=val" arguments.'''
+
+    def __init__(self, args=()):
+        # {entry id: (name, value)}, in the order of the arguments; value is True for flags
+        self.entries = OrderedDict()
+        # {name: [entry id]}
+        self.names = {}
+        self.next_id = 0
+        self.parse(args)
+
+    def parse(self, args):
+        args = list(args)
+        position = 0
+        while position < len(args):
+            arg = args[position]
+            position += 1
+            match = LONG_OPTION_PATTERN.match(arg)
+            if match:
+                name, value = match.group(1), match.group(2)
+                if value is None and name not in FLAG_OPTIONS and position < len(args) and not args[position].startswith('-'):
+                    value = args[position]
+                    position += 1
+            else:
+                match = SHORT_OPTION_PATTERN.match(arg)
+                if not match or match.group(1) not in SHORT_OPTIONS:
+                    # not an option, e.g. an input file
+                    self.add(None, arg)
+                    continue
+                name, takes_value = SHORT_OPTIONS[match.group(1)]
+                value = match.group(2) or None
+                if not takes_value and value is not None:
+                    # combined flags, e.g. "-sN"
+                    args.insert(position, '-' + value)
+                    value = None
+                elif takes_value and value is None and position < len(args):
+                    value = args[position]
+                    position += 1
+            self.add(name, True if value is None else value)
+
+    def copy(self):
+        other = PandocArguments()
+        other.entries = OrderedDict(self.entries)
+        other.names = dict((name, list(ids)) for name, ids in self.names.items())
+        other.next_id = self.next_id
+        return other
+
+    def normalize(self, name):
+        return OPTION_ALIASES.get(name, name)
+
+    def get(self, name):
+        '''Get the first value for an argument (True for flags, None when missing).'''
+        ids = self.names.get(self.normalize(name))
+        if not ids:
+            return None
+        return self.entries[ids[0]][1]
 
-        # open automatically with the sublime text plugin "view in browser"
-        # self.window.run_command('view_in_browser')
-        # window().run_command("view_in_browser")
-        # view.run_command("view_in_browser")
-        # self.view.window().run_command("save")
+    def get_all(self, name):
+        return [self.entries[entry_id][1] for entry_id in self.names.get(self.normalize(name), ())]
 
+    def add(self, name, value=True):
+        if name is not None:
+            name = self.normalize(name)
+        self.entries[self.next_id] = (name, value)
+        self.names.setdefault(name, []).append(self.next_id)
+        self.next_id += 1
 
+    def remove(self, name):
+        '''Remove all occurrences of an argument.'''
+        for entry_id in self.names.pop(self.normalize(name), ()):
+            del self.entries[entry_id]
 
-class evaluate_short_long_arguments(list):
+    def set(self, name, value=True):
+        '''Replace all occurrences of an argument with one.'''
+        self.remove(name)
+        self.add(name, value)
 
-    '''Process pandoc arguments.
+    def __contains__(self, name):
+        return bool(self.names.get(self.normalize(name)))
 
-    "short" form: "-k val"
-    "long" form:  "--key=val"   '''
+    def items(self):
+        '''Return [(name, value)]; name is None for arguments which are not options.'''
+        return list(self.entries.values())
 
-    def get(self, short=None, long=None):
-        '''Get the first value for a argument.'''
-        value = None
-        for arg in self:
-            if short is not None:
-                if value:
-                    return arg
-                match = re.search('^-(' + '|'.join(short) + ')$', arg)
-                if match:
-                    value = True  # grab the next arg
-                    continue
-            if long is not None:
-                match = re.search('^--(' + '|'.join(long) + ')=(.+)$', arg)
-                if match:
-                    return match.group(2)
+    def as_list(self, items=None):
+        args = []
+        for name, value in (self.items() if items is None else items):
+            if name is None:
+                args.append(value)
+            elif value is True:
+                args.append('--' + name)
+            else:
+                args.append('--' + name + '=' + value)
+        return args
+
+    def __repr__(self):
+        return 'PandocArguments(' + repr(self.as_list()) + ')'
+
+
+class ResolvedSettings(Mapping):
+
+    '''Read-only settings (see freeze_settings), with the pandoc arguments of every
+    transformation parsed once, when the settings are loaded, and the ranking of
+    the transformations per scope, computed once per syntax.'''
+
+    def __init__(self, settings):
+        self.settings = freeze_settings(settings)
+        self.arguments = {}
+        for name, transformation in self.settings.get('transformations', {}).items():
+            self.arguments[name] = PandocArguments(transformation.get('pandoc-arguments', ()))
+        # {scope name: OrderedDict([(transformation name, input format)])}, see rank()
+        self.rankings = {}
+
+    def rank(self, scope_name):
+        '''Return the transformations available for a scope (view.scope_name(0)), best
+        matching first, as an OrderedDict of their names to the input format of their
+        best matching scope.'''
+
+        ranking = self.rankings.get(scope_name)
+        if ranking is not None:
+            return ranking
+
+        ranked = []
+        for name, transformation in self.settings.get('transformations', {}).items():
+            best_score, best_format = 0, None
+            for scope, input_format in transformation.get('scope', {}).items():
+                score = sublime.score_selector(scope_name, scope)
+                if score > best_score:
+                    best_score, best_format = score, input_format
+            if best_score:
+                ranked.append((best_score, name, best_format))
+
+        # sort by score, descending (stable, equal scores keep the order of the settings)
+        ranked.sort(key=lambda entry: -entry[0])
+        ranking = OrderedDict((name, input_format) for unused_score, name, input_format in ranked)
+        self.rankings[scope_name] = ranking
+        return ranking
+
+    def __getitem__(self, key):
+        return self.settings[key]
+
+    def __iter__(self):
+        return iter(self.settings)
+
+    def __len__(self):
+        return len(self.settings)
+
+
+class PandocServerUnavailable(Exception):
+
+    '''The pandoc server could not be started or reached.'''
+
+
+class PandocServerError(Exception):
+
+    '''The pandoc server could not convert a document.'''
+
+
+class WorkerUnavailable(Exception):
+
+    '''The worker process could not be started or reached.'''
+
+
+class SpandocWorker(object):
+
+    '''Client of the worker process (worker/spandoc_worker.py), which runs pandoc for
+    all windows, caches the outputs and shares identical conversions running at once.
+
+    The worker listens on a Unix domain socket in the cache folder of Sublime. It is
+    started on the first request, with the Python of the "worker_python" setting, and
+    exits by itself after "worker_idle_timeout" seconds without requests. Its stderr
+    goes to worker.log next to the socket.'''
+
+    def __init__(self, settings):
+        self.python = settings.get('worker_python') or 'python3'
+        self.idle_timeout = settings.get('worker_idle_timeout', 600)
+        self.socket_path = get_worker_socket_path()
+
+    def request(self, request, conversion=None, start=True, timeout=None):
+        '''Send a request and return the decoded response, starting the worker if needed.'''
+
+        for attempt in range(2):
+            try:
+                return self.send(request, conversion, timeout)
+            except (FileNotFoundError, ConnectionRefusedError) as e:
+                if not start or attempt:
+                    raise WorkerUnavailable(str(e))
+            with worker_lock:
+                if not self.is_running():
+                    self.start()
+
+    def send(self, request, conversion, timeout):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(timeout)
+            sock.connect(self.socket_path)
+            if conversion is not None:
+                conversion.started(WorkerConnection(sock))
+            sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+            chunks = []
+            for chunk in iter(lambda: sock.recv(OUTPUT_CHUNK_SIZE), b''):
+                chunks.append(chunk)
+        except (FileNotFoundError, ConnectionRefusedError):
+            raise
+        except OSError as e:
+            if conversion is not None and conversion.cancelled:
+                return {}
+            raise WorkerUnavailable(str(e))
+        finally:
+            sock.close()
+        try:
+            return json.loads(b''.join(chunks).decode('utf-8'))
+        except ValueError:
+            if conversion is not None and conversion.cancelled:
+                return {}
+            raise WorkerUnavailable('the worker did not answer')
+
+    def is_running(self):
+        try:
+            self.send({'command': 'health'}, None, 1)
+        except (OSError, WorkerUnavailable):
+            return False
+        return True
+
+    def start(self):
+        cmd = [self.python, get_worker_script(), '--socket', self.socket_path, '--idle-timeout', str(self.idle_timeout)]
+        if get_package_settings().get('max_jobs'):
+            cmd += ['--jobs', str(get_package_settings().get('max_jobs'))]
+        debug("starting the worker: " + format_command(cmd))
+        # the stderr of the worker goes to a log file (a pipe would break once the plugin stops reading it)
+        log_path = get_worker_log_path()
+        try:
+            os.makedirs(os.path.dirname(log_path), mode=0o700, exist_ok=True)
+            log_file = open(log_path, 'wb')
+        except OSError as e:
+            debug("Could not open the log of the worker: " + str(e))
+            log_file = None
+        try:
+            # the worker outlives the plugin (e.g. when it is reloaded), until it is idle
+            process = popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                            stderr=log_file if log_file is not None else subprocess.DEVNULL, start_new_session=True)
+        except OSError as e:
+            raise WorkerUnavailable('Could not run "worker_python" ' + repr(self.python) + ': ' + str(e))
+        finally:
+            if log_file is not None:
+                log_file.close()
+
+        # wait until the worker answers
+        deadline = time.time() + WORKER_START_TIMEOUT
+        while time.time() < deadline:
+            if self.is_running():
+                debug("worker is running on " + self.socket_path)
+                return
+            if process.poll() is not None:
+                raise WorkerUnavailable(read_worker_log(log_path) or 'the worker exited')
+            time.sleep(0.05)
+        raise WorkerUnavailable('the worker did not answer within ' + str(WORKER_START_TIMEOUT) + 's')
+
+
+class WorkerConnection(object):
+
+    '''A request to the worker, which Conversion.cancel() stops like a process (see kill).'''
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.closed = False
+
+    def poll(self):
+        return 0 if self.closed else None
+
+    def kill(self):
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+def get_worker_socket_path():
+
+    # the worker makes its folder accessible to the user only
+    return os.path.join(sublime.cache_path(), 'Spandoc', 'worker', 'worker.sock')
+
+
+def get_worker_log_path():
+
+    return os.path.join(os.path.dirname(get_worker_socket_path()), 'worker.log')
+
+
+def read_worker_log(log_path):
+    '''Return the end of the log of the worker (e.g. the traceback of a failed start).'''
+
+    try:
+        with open(log_path, 'rb') as log_file:
+            log_file.seek(max(os.path.getsize(log_path) - ERROR_TAIL_SIZE, 0))
+            return log_file.read().decode('utf-8', 'replace').strip()
+    except OSError:
+        return ''
+
+
+def get_worker_script():
+    '''Return the path of worker/spandoc_worker.py, extracted to the cache folder when
+    the package is installed as a .sublime-package (zip) file.'''
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'worker', 'spandoc_worker.py')
+    if os.path.isfile(script):
+        return script
+    script = os.path.join(sublime.cache_path(), 'Spandoc', 'spandoc_worker.py')
+    data = sublime.load_binary_resource('Packages/' + __package__ + '/worker/spandoc_worker.py')
+    os.makedirs(os.path.dirname(script), exist_ok=True)
+    with open(script, 'wb') as script_file:
+        script_file.write(data)
+    return script
+
+
+class PandocServer(object):
+
+    '''A long-lived `pandoc server` process, serving conversions over HTTP on localhost.
+
+    The process is started with the first conversion, health-checked via
+    `/version` and restarted when it has crashed. Connections to it are pooled.'''
+
+    def __init__(self, pandoc_path):
+        self.pandoc_path = pandoc_path
+        self.process = None
+        self.port = None
+        self.lock = threading.Lock()
+        self.connections = queue.LifoQueue(maxsize=4)
+
+    def ensure_running(self):
+        with self.lock:
+            if self.process is not None and self.process.poll() is None:
+                return
+            if self.process is not None:
+                debug("pandoc server exited with " + str(self.process.returncode) + ", restarting it")
+            self.start()
+
+    def start(self):
+        self.drop_connections()
+        self.port = get_free_port()
+        cmd = [self.pandoc_path, 'server', '--port', str(self.port), '--timeout', str(PANDOC_SERVER_TIMEOUT)]
+        debug("starting pandoc server: " + str(cmd))
+        try:
+            self.process = popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        except OSError as e:
+            self.process = None
+            raise PandocServerUnavailable(str(e))
+
+        # wait until the server answers
+        deadline = time.time() + PANDOC_SERVER_START_TIMEOUT
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                error = self.process.stderr.read().decode('utf-8', 'replace').strip()
+                self.process = None
+                raise PandocServerUnavailable(error or 'pandoc server exited')
+            if self.is_healthy():
+                debug("pandoc server is running on port " + str(self.port))
+                return
+            time.sleep(0.05)
+        self.stop()
+        raise PandocServerUnavailable('pandoc server did not answer within ' + str(PANDOC_SERVER_START_TIMEOUT) + 's')
+
+    def is_healthy(self):
+        try:
+            status, unused_body = self.request('GET', '/version', timeout=1)
+        except (OSError, http.client.HTTPException):
+            return False
+        return status == 200
+
+    def stop(self):
+        self.drop_connections()
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+        self.process = None
+
+    def drop_connections(self):
+        while True:
+            try:
+                self.connections.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def request(self, method, path, body=None, timeout=None):
+        try:
+            connection = self.connections.get_nowait()
+        except queue.Empty:
+            connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=timeout)
+        connection.timeout = timeout
+        try:
+            connection.request(method, path, body, {'Content-Type': 'application/json', 'Accept': 'application/json'})
+            response = connection.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            raise
+        try:
+            self.connections.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+        return (response.status, body)
+
+    def convert(self, params):
+        '''Convert with the server, (re)starting it when needed. Returns the decoded JSON response.'''
+
+        body = json.dumps(params).encode('utf-8')
+        for attempt in range(2):
+            self.ensure_running()
+            try:
+                status, response = self.request('POST', '/', body)
+                break
+            except (OSError, http.client.HTTPException) as e:
+                # the server may have crashed in the meantime: restart it once
+                debug("pandoc server request failed: " + str(e))
+                with self.lock:
+                    self.stop()
+        else:
+            raise PandocServerUnavailable('pandoc server did not answer')
+
+        # a conversion taking longer than the timeout of the server is left to the command line
+        if status == 503:
+            raise PandocServerUnavailable('pandoc server timed out: ' + response.decode('utf-8', 'replace').strip())
+        try:
+            response = json.loads(response.decode('utf-8'))
+        except ValueError:
+            raise PandocServerError(response.decode('utf-8', 'replace').strip())
+        if status != 200 or not isinstance(response, dict) or 'error' in response:
+            error = response.get('error') if isinstance(response, dict) else response
+            raise PandocServerError(str(error))
+        return response
+
+
+def get_pandoc_server(pandoc_path):
+
+    with pandoc_servers_lock:
+        server = pandoc_servers.get(pandoc_path)
+        if server is None:
+            server = pandoc_servers[pandoc_path] = PandocServer(pandoc_path)
+    return server
+
+
+def stop_pandoc_servers():
+
+    with pandoc_servers_lock:
+        servers = list(pandoc_servers.values())
+        pandoc_servers.clear()
+    for server in servers:
+        with server.lock:
+            server.stop()
+
+
+def get_free_port():
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+def get_server_params(pandoc_arguments, input_format):
+    '''Translate pandoc arguments (PandocArguments) into the JSON parameters of `pandoc server`.
+
+    Returns None, when an argument has no server equivalent (e.g. files like
+    templates, filters or the output file of binary formats), or when the output
+    format embeds images (see SERVER_EMBEDDING_FORMATS).'''
+
+    params = {'from': input_format}
+    for name, value in pandoc_arguments.items():
+        if name == 'output':
+            # the output is written by Spandoc
+            continue
+        kind = SERVER_OPTIONS.get(name)
+        if kind is None:
+            return None
+        key = kind[1] if len(kind) > 1 else name
+        if kind[0] is bool:
+            params[key] = True
+        elif value is True:
+            # missing value
+            return None
+        elif kind[0] is dict:
+            # KEY:VALUE or KEY=VALUE, split at the first of both
+            entry = VARIABLE_SEPARATOR_PATTERN.split(value, 1)
+            params.setdefault(key, {})[entry[0]] = entry[1] if len(entry) > 1 and entry[1] else True
+        elif kind[0] is int:
+            try:
+                params[key] = int(value)
+            except ValueError:
+                return None
+        else:
+            params[key] = value
+    if FORMAT_EXTENSION_PATTERN.split(params.get('to', 'html'), 1)[0] in SERVER_EMBEDDING_FORMATS:
         return None
+    return params
 
-    def remove(self, short=None, long=None, values=None):
-        '''Remove all matching arguments.'''
-        ret = evaluate_short_long_arguments([])
-        value = None
-        for arg in self:
-            if short is not None:
-                if value:
-                    if values is not None and arg not in values:
-                        ret.append(arg)
-                    value = None
-                    continue
-                match = re.search('^-(' + '|'.join(short) + ')$', arg)
-                if match:
-                    value = True  # grab the next arg
-                    continue
-            if long is not None:
-                match = re.search('^--(' + '|'.join(long) + ')=(.+)$', arg)
-                if match:
+
+def format_server_message(message):
+    '''Format a log message of `pandoc server` ({"verbosity": ..., "type": ..., fields}) like pandoc's stderr.'''
+
+    if not isinstance(message, dict):
+        return str(message)
+    fields = ', '.join(str(name) + ': ' + str(value) for name, value in sorted(message.items()) if name not in ('verbosity', 'type'))
+    return '[' + str(message.get('verbosity', 'WARNING')) + '] ' + str(message.get('type', '')) + (' (' + fields + ')' if fields else '')
+
+
+class MemoryCache(object):
+
+    '''In-memory cache of pandoc outputs (e.g. JSON ASTs), keyed by a hash of the
+    input and the pandoc command. The least recently used outputs are evicted beyond
+    max_size bytes. An output being made by one thread is waited for by the others.'''
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.size = 0
+        self.parsing = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, parse, max_size):
+        while True:
+            with self.lock:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    debug("Took the output from the memory cache: " + key)
+                    return self.entries[key]
+                event = self.parsing.get(key)
+                if event is None:
+                    event = self.parsing[key] = threading.Event()
+                    break
+            # parsed by another thread, if it failed, parse it here
+            event.wait()
+
+        try:
+            ast = parse()
+            with self.lock:
+                self.entries[key] = ast
+                self.size += len(ast)
+                while self.size > max_size and self.entries:
+                    unused_key, evicted = self.entries.popitem(last=False)
+                    self.size -= len(evicted)
+        finally:
+            with self.lock:
+                self.parsing.pop(key).set()
+        return ast
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+# parsed documents of all conversions
+ast_cache = MemoryCache()
+# converted shards of sharded conversions, see get_shards()
+shard_cache = MemoryCache()
+
+
+def split_reader_arguments(pandoc_arguments):
+    '''Split pandoc arguments (PandocArguments) into those of the reader and the others (writer, filters, output, ...).'''
+
+    reader, writer = [], []
+    for name, value in pandoc_arguments.items():
+        (reader if name in READER_OPTIONS else writer).append((name, value))
+    return (pandoc_arguments.as_list(reader), pandoc_arguments.as_list(writer))
+
+
+def get_shards(conversion):
+    '''Return (metadata, shards) of the input of a conversion, split at its top-level headings,
+    or None, when the conversion can not be sharded.
+
+    Sharding needs markdown input, an output format which can be stitched
+    together (see SHARD_OUTPUT_FORMATS), no preprocessors, no options which need
+    the whole document (table of contents, numbering, citations, filters), no
+    footnotes, no headings with the same identifier in several shards and no
+    links to the headings of other shards (see get_shard_conflicts).
+    Documents smaller than "shard_min_size" KB are not sharded.'''
+
+    def base_format(name):
+        return re.split(r'[+-]', name, 1)[0]
+
+    reason = None
+    if conversion.preprocessors:
+        reason = "preprocessors"
+    elif base_format(conversion.input_format) not in SHARD_INPUT_FORMATS:
+        reason = "input format " + conversion.input_format
+    elif base_format(conversion.output_format) not in SHARD_OUTPUT_FORMATS:
+        reason = "output format " + conversion.output_format
+    else:
+        unsupported = [name for name in SHARD_UNSUPPORTED_OPTIONS if name in conversion.pandoc_arguments]
+        if unsupported:
+            reason = "--" + ", --".join(sorted(unsupported))
+    if reason is not None:
+        debug("Not sharded (" + reason + "): " + conversion.name)
+        return None
+
+    contents = conversion.contents
+    if contents is None:
+        try:
+            size = os.path.getsize(conversion.input_path())
+        except OSError as e:
+            raise ConversionError('Could not read ' + conversion.file_name + ': ' + str(e))
+        if size < conversion.settings.get('shard_min_size', 1024) * 1024:
+            return None
+        contents = conversion.read_input()
+    elif len(contents) < conversion.settings.get('shard_min_size', 1024) * 1024:
+        return None
+
+    try:
+        text = contents.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+    if SHARD_FOOTNOTE_PATTERN.search(text):
+        debug("Not sharded (footnotes): " + conversion.name)
+        return None
+
+    metadata, shards = split_shards(text)
+    if len(shards) < 2:
+        return None
+    reason = get_shard_conflicts(shards)
+    if reason is not None:
+        debug("Not sharded (" + reason + "): " + conversion.name)
+        return None
+    return (metadata.encode('utf-8'), [shard.encode('utf-8') for shard in shards])
+
+
+def split_shards(text):
+    '''Split a markdown document before its top-level headings (outside of code blocks,
+    fenced divs, HTML comments and HTML blocks).
+
+    Returns (metadata, shards): the metadata block (YAML or title block) at the
+    start of the document, and the shards. The text before the second heading is
+    the first shard. Every shard gets the link reference definitions of the
+    other shards it needs.'''
+
+    lines = text.splitlines(True)
+
+    # metadata: a YAML block or a pandoc title block at the start
+    metadata_end = 0
+    if lines and lines[0].rstrip() == '---':
+        for number in range(1, len(lines)):
+            if lines[number].rstrip() in ('---', '...'):
+                metadata_end = number + 1
+                break
+    else:
+        while metadata_end < len(lines) and lines[metadata_end].startswith('%'):
+            metadata_end += 1
+
+    starts = []
+    fence = None
+    # whether a line is in an HTML comment, and the depth of the fenced divs and HTML blocks it is in
+    comment = False
+    div_depth = 0
+    html_depth = 0
+    for number in range(metadata_end, len(lines)):
+        line = lines[number]
+        if fence is not None:
+            if line.strip().startswith(fence) and not line.strip().strip(fence[0]):
+                fence = None
+            continue
+        top_level = not comment and div_depth == 0 and html_depth == 0
+        if not comment:
+            match = SHARD_FENCE_PATTERN.match(line)
+            if match:
+                fence = match.group(1)
+                continue
+            match = SHARD_DIV_FENCE_PATTERN.match(line)
+            if match:
+                div_depth = div_depth + 1 if match.group(1) else max(div_depth - 1, 0)
+                continue
+        comment, html_depth = scan_shard_html(line, comment, html_depth)
+        if not top_level:
+            continue
+        if SHARD_HEADING_PATTERN.match(line):
+            starts.append(number)
+        elif (line.strip() and number + 1 < len(lines) and SHARD_SETEXT_PATTERN.match(lines[number + 1])
+                and (number == metadata_end or not lines[number - 1].strip())):
+            starts.append(number)
+
+    # the text before the second heading (metadata, preface, first chapter) is the first shard
+    bounds = [0] + starts[1:] + [len(lines)]
+    shards = [''.join(lines[start:end]) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+    references = [line for line in lines if SHARD_REFERENCE_PATTERN.match(line)]
+    if references and len(shards) > 1:
+        for number, shard in enumerate(shards):
+            missing = [line for line in references if line not in shard]
+            if missing:
+                shards[number] = shard.rstrip('\n') + '\n\n' + ''.join(line.rstrip('\r\n') + '\n' for line in missing)
+
+    return (''.join(lines[:metadata_end]), shards)
+
+
+def scan_shard_html(line, comment, depth):
+    '''Return (in an HTML comment, depth of HTML blocks) after a line, see split_shards.'''
+
+    for match in SHARD_HTML_PATTERN.finditer(line):
+        token = match.group(0)
+        if comment:
+            if token == '-->':
+                comment = False
+        elif token == '<!--':
+            comment = True
+        elif token != '-->':
+            depth = max(depth - 1 if match.group(1) else depth + 1, 0)
+    return (comment, depth)
+
+
+def get_shard_conflicts(shards):
+    '''Return why the shards would be converted differently than the whole document, None if not.
+
+    pandoc numbers the identifiers of headings with the same text ("intro", "intro-1"),
+    and links implicitly to headings by their text ("[Chapter Two]"). Both need the
+    whole document, so shards with headings of the same identifier or with links
+    to the headings of other shards are not converted separately.'''
+
+    identifiers = {}
+    titles = {}
+    for number, shard in enumerate(shards):
+        for title, identifier in get_shard_headings(shard):
+            if identifiers.setdefault(identifier, number) != number:
+                return "headings with the identifier " + identifier + " in several chapters"
+            titles.setdefault(' '.join(title.lower().split()), set()).add(number)
+    for number, shard in enumerate(shards):
+        for match in SHARD_BRACKETS_PATTERN.finditer(shard):
+            owners = titles.get(' '.join(match.group(1).lower().split()))
+            if owners and number not in owners:
+                return "a link to the heading " + match.group(1) + " of another chapter"
+    return None
+
+
+def get_shard_headings(text):
+    '''Yield (title, identifier) of the headings of a markdown text (outside of code blocks).
+
+    The identifier is the explicit one ({#id}), or an approximation of pandoc's
+    automatic identifier, which only keeps letters and digits, so it never tells
+    apart identifiers which pandoc would make the same.'''
+
+    lines = text.splitlines()
+    fence = None
+    for number, line in enumerate(lines):
+        if fence is not None:
+            if line.strip().startswith(fence) and not line.strip().strip(fence[0]):
+                fence = None
+            continue
+        match = SHARD_FENCE_PATTERN.match(line)
+        if match:
+            fence = match.group(1)
+            continue
+        match = SHARD_ANY_HEADING_PATTERN.match(line)
+        if match:
+            title = match.group(1) or ''
+        elif (line.strip() and number + 1 < len(lines) and SHARD_ANY_SETEXT_PATTERN.match(lines[number + 1])
+                and (number == 0 or not lines[number - 1].strip())):
+            title = line.strip()
+        else:
+            continue
+
+        attributes = SHARD_ATTRIBUTES_PATTERN.search(title)
+        if attributes:
+            title = title[:attributes.start()]
+            explicit = [part[1:] for part in attributes.group(1).split() if part.startswith('#')]
+            if explicit:
+                yield (title, explicit[0])
+                continue
+        # pandoc drops everything before the first letter, an empty identifier becomes "section"
+        identifier = ''.join(character for character in title.lower() if character.isalnum())
+        identifier = identifier[next((position for position, character in enumerate(identifier) if character.isalpha()), len(identifier)):]
+        yield (title, identifier or 'section')
+
+
+class OutputCache(object):
+
+    '''Content-addressed store of conversion outputs.
+
+    Every entry is one file named by its key. Reading an entry updates its
+    mtime, so when the store grows beyond max_size, the least recently used
+    entries are evicted.'''
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+    def entry(self, key):
+        return os.path.join(self.path, key)
+
+    def place(self, key, destination):
+        '''Copy the output of an entry into place. False on a miss.
+
+        The entry is copied, not hardlinked: an output edited in place must not
+        change the entry.'''
+
+        entry = self.entry(key)
+        if not os.path.isfile(entry):
+            return False
+        touch(entry)
+        if destination is None:
+            return True
+        temp = destination + '.spandoc-' + str(threading.get_ident()) + '.tmp'
+        try:
+            shutil.copyfile(entry, temp)
+            os.replace(temp, destination)
+        except OSError:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+        return True
+
+    def read(self, key):
+        with open(self.entry(key), 'rb') as entry:
+            return entry.read()
+
+    def put_file(self, key, source):
+        if os.path.isfile(source):
+            self.store(key, lambda temp: shutil.copyfile(source, temp))
+
+    def put_bytes(self, key, data):
+        def write(temp):
+            with open(temp, 'wb') as entry:
+                entry.write(data)
+        self.store(key, write)
+
+    def store(self, key, write):
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            temp = self.entry(key) + '.' + str(threading.get_ident()) + '.tmp'
+            write(temp)
+            os.replace(temp, self.entry(key))
+        except OSError as e:
+            debug("Could not store in the output cache: " + str(e))
+            return
+        self.evict()
+
+    def entries(self):
+        '''Return [(mtime, size, path)] of all entries, least recently used first.'''
+
+        entries = []
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return entries
+        for name in names:
+            path = os.path.join(self.path, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        return entries
+
+    def evict(self):
+        with self.lock:
+            entries = self.entries()
+            size = sum(entry[1] for entry in entries)
+            for unused_mtime, entry_size, path in entries:
+                if size <= self.max_size:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
                     continue
-            ret.append(arg)
-        return ret
+                size -= entry_size
+
+    def clear(self):
+        with self.lock:
+            for unused_mtime, unused_size, path in self.entries():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+def get_output_cache(settings):
+    '''Return the output cache, None when it is disabled ("output_cache_size": 0).'''
+
+    max_size = settings.get('output_cache_size', 0)
+    if not max_size:
+        return None
+    return OutputCache(os.path.join(sublime.cache_path(), 'Spandoc', 'outputs'), max_size * 1024 * 1024)
+
+
+def get_output_cache_key(conversion):
+    '''Hash of everything the output of a conversion depends on.
+
+    That is the pandoc version, the pandoc command, the input and the files
+    named in the pandoc arguments (templates, includes, bibliographies, ...).
+    None when the pandoc version is unknown.'''
+
+    version = get_pandoc_version(conversion.pandoc_cmd[0])
+    if version is None:
+        return None
+
+    key = hashlib.sha256()
+    key.update(version.encode('utf-8'))
+    key.update(json.dumps(conversion.pandoc_cmd).encode('utf-8'))
+    if conversion.contents is not None:
+        key.update(conversion.contents)
+    else:
+        hash_file(key, conversion.input_path())
+    for file_name in get_argument_files(conversion.pandoc_arguments):
+        key.update(file_name.encode('utf-8'))
+        hash_file(key, os.path.join(conversion.folder_path or '', os.path.expanduser(file_name)))
+    return key.hexdigest()
+
+
+def get_pdf_engine(conversion):
+    '''Return the path of the LaTeX engine of an incremental PDF build, None when the
+    conversion is not one.
+
+    Incremental builds are made for transformations with "incremental_pdf": true, which
+    write a PDF file from LaTeX with pdflatex, xelatex or lualatex (found in the PATH),
+    of documents whose images are local PDF, PNG or JPEG files (see get_pdf_images);
+    other PDFs are left to pandoc.'''
+
+    if conversion.transformation.get('incremental_pdf') is not True or conversion.output_name is None:
+        return None
+    if os.path.splitext(conversion.output_name)[1].lower() != '.pdf' or conversion.output_format not in ('latex', 'beamer'):
+        return None
+    arguments = conversion.pandoc_arguments
+    engine = arguments.get('pdf-engine') or arguments.get('latex-engine') or 'pdflatex'
+    if engine is True or os.path.splitext(os.path.basename(engine))[0].lower() not in PDF_ENGINES:
+        debug("No incremental PDF build with the engine: " + str(engine))
+        return None
+    for image in get_pdf_images(conversion.read_input().decode('utf-8', 'replace')):
+        if PDF_URL_PATTERN.match(image) or os.path.splitext(image)[1].lower() not in PDF_NATIVE_IMAGE_EXTENSIONS:
+            debug("No incremental PDF build with the image: " + image)
+            return None
+    return shutil.which(engine)
+
+
+def get_pdf_images(text):
+    '''Return the images of a document: inline and reference images of markdown,
+    <img> of HTML and \\includegraphics of LaTeX.'''
+
+    images = [next(group for group in match.groups() if group) for match in PDF_IMAGE_PATTERN.finditer(text)]
+    labels = set(' '.join((match.group(2) or match.group(1)).lower().split()) for match in PDF_IMAGE_REFERENCE_PATTERN.finditer(text))
+    for match in PDF_REFERENCE_DEFINITION_PATTERN.finditer(text):
+        if ' '.join(match.group(1).lower().split()) in labels:
+            images.append(match.group(2))
+    return images
+
+
+def get_pdf_build_dir(output_path, engine):
+    '''Return (and create) the build directory of an incremental PDF build.'''
+
+    key = hashlib.sha1((os.path.abspath(output_path) + '\0' + engine).encode('utf-8')).hexdigest()
+    build_dir = os.path.join(sublime.cache_path(), 'Spandoc', 'pdf', key)
+    os.makedirs(build_dir, exist_ok=True)
+    return build_dir
+
+
+def get_pdf_build_lock(build_dir):
+
+    with pdf_build_locks_lock:
+        return pdf_build_locks.setdefault(build_dir, threading.Lock())
+
+
+def hash_build_files(build_dir, job_name):
+    '''Return the hashes of the files read by the next LaTeX run ({extension: hash}).'''
+
+    hashes = {}
+    for extension in PDF_RERUN_EXTENSIONS:
+        key = hashlib.sha1()
+        hash_file(key, os.path.join(build_dir, job_name + extension))
+        hashes[extension] = key.hexdigest()
+    return hashes
+
+
+def get_latex_errors(log_path):
+    '''Return the errors (lines starting with "!" and their context) of a LaTeX log file.'''
+
+    try:
+        with open(log_path, encoding='utf-8', errors='replace') as log_file:
+            lines = log_file.read().splitlines()
+    except OSError:
+        return ''
+    errors = []
+    for position, line in enumerate(lines):
+        if line.startswith('!'):
+            errors.extend(lines[position:position + 3])
+    return '\n'.join(errors[:30])
+
+
+def get_argument_files(pandoc_arguments):
+    '''Return the file names, which are values of pandoc arguments (PandocArguments).'''
+
+    return [value for name, value in pandoc_arguments.items() if name in FILE_OPTIONS and value and value is not True]
+
+
+def hash_file(key, file_path):
+    '''Update a hash with the content of a file, in chunks (missing files are skipped).'''
+
+    try:
+        with open(file_path, 'rb') as hashed_file:
+            for chunk in iter(lambda: hashed_file.read(65536), b''):
+                key.update(chunk)
+    except (OSError, TypeError):
+        key.update(b'\0missing')
+
+
+def get_pandoc_version(pandoc_path):
+    '''Return (and cache) the first line of `pandoc --version`, None when pandoc can not be run.'''
+
+    with pandoc_versions_lock:
+        if pandoc_path in pandoc_versions:
+            return pandoc_versions[pandoc_path]
+    try:
+        output = subprocess.check_output([pandoc_path, '--version'], stdin=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        version = output.decode('utf-8', 'replace').splitlines()[0].strip()
+    except (OSError, subprocess.CalledProcessError, IndexError):
+        version = None
+    debug("pandoc version: " + str(version))
+    with pandoc_versions_lock:
+        pandoc_versions[pandoc_path] = version
+    return version
+
+
+def get_pandoc_formats(pandoc_path):
+    '''Return (and cache) the input and output formats of pandoc (frozensets), None when
+    pandoc can not list them (before pandoc 1.18).'''
+
+    with pandoc_versions_lock:
+        if pandoc_path in pandoc_formats:
+            return pandoc_formats[pandoc_path]
+    try:
+        formats = tuple(
+            frozenset(subprocess.check_output([pandoc_path, option], stdin=subprocess.DEVNULL, stderr=subprocess.DEVNULL).decode('utf-8', 'replace').split())
+            for option in ('--list-input-formats', '--list-output-formats'))
+    except (OSError, subprocess.CalledProcessError):
+        formats = None
+    debug("pandoc formats: " + str(formats))
+    with pandoc_versions_lock:
+        pandoc_formats[pandoc_path] = formats
+    return formats
+
+
+def find_pandoc(pandoc_path):
+    '''Return the pandoc executable of the "pandoc_path" setting, None when it can not be found.
+
+    An empty setting or a name without a folder (e.g. "pandoc") is looked up in the PATH.'''
+
+    with pandoc_versions_lock:
+        if pandoc_path in pandoc_paths:
+            return pandoc_paths[pandoc_path]
+    if not pandoc_path:
+        found = shutil.which('pandoc')
+    elif os.path.dirname(pandoc_path):
+        found = os.path.expanduser(pandoc_path)
+        if not (os.path.isfile(found) and os.access(found, os.X_OK)):
+            found = None
+    else:
+        found = shutil.which(pandoc_path)
+    debug("pandoc_path " + repr(pandoc_path) + ": " + str(found))
+    # not found is not cached, pandoc may be installed later
+    if found is not None:
+        with pandoc_versions_lock:
+            pandoc_paths[pandoc_path] = found
+    return found
+
+
+def touch(file_path):
+
+    try:
+        os.utime(file_path, None)
+    except OSError:
+        pass
+
 
+class SpandocOutputCacheCommand(sublime_plugin.WindowCommand):
+
+    '''Shows the size of the output cache in an output panel, or clears it (action "clear").'''
+
+    def run(self, action="show"):
+        view, folder_path, unused_file_name = get_current(self.window)
+        settings = get_settings(view, folder_path)
+        if settings is None:
+            return
+        cache = get_output_cache(settings)
+        if cache is None:
+            sublime.status_message("Spandoc: the output cache is disabled (\"output_cache_size\": 0)")
+            return
+
+        if action == "clear":
+            cache.clear()
+            sublime.status_message("Spandoc: output cache cleared")
+            return
+
+        entries = cache.entries()
+        size = sum(entry[1] for entry in entries)
+        lines = [
+            "Spandoc output cache: " + cache.path,
+            "entries: " + str(len(entries)),
+            "size: " + format_size(size) + " of " + format_size(cache.max_size),
+        ]
+        if entries:
+            lines.append("least recently used: " + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entries[0][0])))
+            lines.append("most recently used: " + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entries[-1][0])))
+        show_panel(self.window, '\n'.join(lines) + '\n')
 
 
 ################################### Global Functions: ###################################
@@ -337,14 +3034,215 @@ def debug(theMessage):
     if DEBUG_MODE:
         print("Spandoc: " + str(theMessage))
 
+def popen(cmd, **kwargs):
+    '''subprocess.Popen, without popping up a console window on Windows.'''
+
+    if os.name == 'nt':
+        startupinfo = subprocess.STARTUPINFO()
+        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+        kwargs.setdefault('startupinfo', startupinfo)
+    return subprocess.Popen(cmd, **kwargs)
+
+
+def format_command(cmd):
+    '''Join a command (list of arguments) to a string, quoted as for the shell.'''
+
+    if os.name == 'nt':
+        return subprocess.list2cmdline(cmd)
+    return ' '.join(shlex.quote(arg) for arg in cmd)
+
+
+def kill(process):
+
+    if process.poll() is None:
+        try:
+            process.kill()
+        except OSError:
+            pass
+
+
+def drain(stream, chunks):
+    '''Read a stream until EOF in a background thread, collecting the chunks.'''
+
+    def read():
+        for chunk in iter(lambda: stream.read(8192), b''):
+            chunks.append(chunk)
+        stream.close()
+
+    thread = threading.Thread(target=read, daemon=True)
+    thread.start()
+    return thread
+
+
+def feed(stream, data):
+    '''Write data to a stream in a background thread and close it.'''
+
+    def write():
+        try:
+            stream.write(data)
+        except (BrokenPipeError, OSError):
+            # the process exited early, its error is reported by its exit code
+            pass
+        finally:
+            try:
+                stream.close()
+            except OSError:
+                pass
+
+    thread = threading.Thread(target=write, daemon=True)
+    thread.start()
+    return thread
+
+
+def write_to_buffer(window, view, text, transformation):
+    '''Show the result of a conversion in a new buffer or in the converted view.'''
+
+    if transformation.get('new-buffer', True) or view is None or not view.is_valid():
+        view = window.new_file()
+    view.run_command('spandoc_replace_content', {'text': text})
+
+    syntax_file = transformation.get('syntax_file')
+    if syntax_file:
+        view.set_syntax_file(syntax_file)
+
+
+def get_preprocessors(transformation, variables):
+    '''Return the preprocessor commands of a transformation as argv lists.
+
+    The "preprocessors" setting is a list of commands (argv lists), which are
+    run in the given order, each one reading the output of its predecessor.
+    `"use_pp": true` prepends the pp preprocessor. `$file`, `$folder`,
+    `$input_format`, `$output_format` and `$output_extension` are substituted
+    in every argument (`$file` is "-", when the input is the buffer).
+
+    Returns (commands, source_on_stdin): when the first command does not use
+    `$file`, the source file has to be passed to it on stdin.'''
+
+    commands = []
+    if transformation.get('use_pp') is True:
+        commands.append(PP_PREPROCESSOR)
+    commands.extend(transformation.get('preprocessors', ()))
+
+    preprocessors = []
+    for command in commands:
+        preprocessors.append([string.Template(arg).safe_substitute(variables) for arg in command])
+    source_on_stdin = bool(commands) and not any('$file' in arg for arg in commands[0])
+    return (preprocessors, source_on_stdin)
+
+
+def start_preprocessors(preprocessors, folder_path, input_file=None, input_bytes=None):
+    '''Start a chain of preprocessors connected by pipes.
+
+    The first preprocessor reads input_file or input_bytes (if given) from
+    stdin. Returns a list of (cmd, process, stderr chunks); the stdout of the
+    last process is left open for the consumer.'''
+
+    stages = []
+    if not preprocessors:
+        return stages
+    if input_file:
+        try:
+            stdin = open(os.path.join(folder_path, input_file), 'rb')
+        except OSError as e:
+            raise ConversionError('Could not read ' + input_file + ': ' + str(e))
+    elif input_bytes is not None:
+        stdin = subprocess.PIPE
+    else:
+        stdin = subprocess.DEVNULL
+    for cmd in preprocessors:
+        debug("preprocessor_cmd: " + format_command(cmd))
+        try:
+            process = popen(cmd, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=folder_path)
+        except OSError as e:
+            # stop the preprocessors already started, they would wait for a reader forever
+            if stdin not in (subprocess.PIPE, subprocess.DEVNULL):
+                stdin.close()
+            kill_stages(stages)
+            raise ConversionError('Could not run ' + format_command(cmd) + '\n\n' + str(e))
+        if stdin is subprocess.PIPE:
+            feed(process.stdin, input_bytes)
+        elif stdin is not subprocess.DEVNULL:
+            stdin.close()
+        error = []
+        drain(process.stderr, error)
+        stages.append((cmd, process, error))
+        stdin = process.stdout
+    return stages
+
+
+def kill_stages(stages):
+    '''Kill the processes of started preprocessors (see start_preprocessors).'''
+
+    for unused_cmd, process, unused_error in stages:
+        kill(process)
+        process.stdout.close()
+
+
+def show_panel(window, text, name='spandoc'):
+    '''Show text in an output panel.'''
+
+    panel = window.create_output_panel(name)
+    panel.run_command('append', {'characters': text})
+    window.run_command('show_panel', {'panel': 'output.' + name})
+
+
+def get_pandoc_panel_title(conversion):
+    '''Return the line above the messages of a conversion in the pandoc output panel.'''
+
+    return "pandoc (" + conversion.name + (", " + conversion.file_name if conversion.file_name else "") + "):\n"
+
+
+def append_to_pandoc_panel(window, text):
+    '''Append text to the pandoc output panel (see PandocErrors) and show it.'''
+
+    panel = window.find_output_panel(PANDOC_PANEL)
+    if panel is None:
+        panel = window.create_output_panel(PANDOC_PANEL)
+    panel.run_command('append', {'characters': text, 'force': True, 'scroll_to_end': True})
+    window.run_command('show_panel', {'panel': 'output.' + PANDOC_PANEL})
+
+
+def clear_pandoc_panel(window):
+    '''Empty the pandoc output panel (before a new conversion writes to it).'''
+
+    panel = window.find_output_panel(PANDOC_PANEL)
+    if panel is not None:
+        panel.run_command('spandoc_replace_content', {'text': ''})
+
+
+def format_size(size):
+
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return str(round(size, 1)) + ' ' + unit
+        size /= 1024.0
+    return str(round(size, 1)) + ' GB'
+
+
+def percentile(values, fraction):
+    '''Return the value below which the fraction of the sorted values lies (nearest rank).'''
+
+    if not values:
+        return 0
+    return values[max(1, int(math.ceil(fraction * len(values)))) - 1]
+
+
+def format_percentiles(stage, values):
+
+    values = sorted(values)
+    return "  " + stage.ljust(14) + (str(round(percentile(values, 0.5) * 1000, 1)) + " ms").rjust(10) + " / " + str(round(percentile(values, 0.95) * 1000, 1)) + " ms"
+
+
 def get_current(window):
 
     # returns the currently edited view.
     view = window.active_view()
+    if view is None:
+        return (None, None, None)
 
     # get current file path:
     current_file_path = view.file_name()
-    debug("current file path: " + current_file_path)
+    debug("current file path: " + str(current_file_path))
     if current_file_path:
         folder_path, file_name = os.path.split(current_file_path)
     else:
@@ -353,51 +3251,131 @@ def get_current(window):
     return (view, folder_path, file_name)
 
 
-def get_settings(view, folder_path=None):
-    '''Return a settings file with the highest precedence: '''
+def get_settings(view, folder_path=None, timing=None):
+    '''Return a settings file with the highest precedence.
+
+    The resolved settings are cached per settings file and returned read-only
+    (dicts become mappingproxies, lists become tuples, see ResolvedSettings). A cached folder
+    settings file is reused as long as its mtime and size are unchanged, the
+    default/user settings as long as Sublime reports no change.
+
+    The search for the folder settings file ("discovery") and the loading of the
+    settings ("settings") are timed with timing, if given.'''
+
+    if timing is None:
+        timing = Timing(None)
 
     # Search for a folder settings file
-    folder_settings_file = search_for_folder_settings_file("spandoc.json", folder_path, view.window())
+    folder_settings_file = None
+    if folder_path:
+        with timing.span('discovery'):
+            folder_settings_file = search_for_folder_settings_file("spandoc.json", folder_path, view.window())
     # debug("folder_settings_file: " + str(folder_settings_file))
 
+    with timing.span('settings'):
+        return get_folder_settings(folder_settings_file)
 
-    # if there is a folder_settings_file, load its settings, else use either the user_settings_file or the default_settings_file
-    if folder_settings_file:
-        settings = load_folder_settings_file(folder_settings_file)
-        # debug("settings: " + str(settings))
 
-        # only the default array is needed
-        default = settings.get('default')
+def get_folder_settings(folder_settings_file):
+    '''Return the (cached) settings of a folder settings file, or the default/user
+    settings, if there is none.'''
 
-    else:
-        settings = sublime.load_settings('Spandoc.sublime-settings')
-        debug("Taking either the user_settings_file (if it exists) or the default_settings_file")
-        # debug("settings: " + str(settings))
+    # if there is no folder_settings_file, use either the user_settings_file or the default_settings_file
+    if not folder_settings_file:
+        return get_package_settings()
 
-        # only the default array is needed
-        default = settings.get('default')
-
-        # but when there is a user array instead of a default array, then merge the settings
-        user = settings.get('user', {})
-        if user:
-            # merge each transformation
-            transformations = default.pop('transformations', {})
-            user_transformations = user.get('transformations', {})
-            for name, data in user_transformations.items():
-                if name in transformations:
-                    transformations[name].update(data)
-                else:
-                    transformations[name] = data
-            default['transformations'] = transformations
-            user.pop('transformations', None)
+    stamp = get_file_stamp(folder_settings_file)
+    with settings_cache_lock:
+        cached = settings_cache.get(folder_settings_file)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
 
-            # merge all other keys
-            default.update(user)
+    settings = load_folder_settings_file(folder_settings_file)
+    # debug("settings: " + str(settings))
+    if settings is None:
+        return None
+
+    # only the default array is needed
+    settings = ResolvedSettings(settings.get('default'))
 
-    settings = default
+    with settings_cache_lock:
+        settings_cache[folder_settings_file] = (stamp, settings)
     return settings
 
 
+def get_package_settings():
+    '''Return the merged default/user settings of Spandoc.sublime-settings.'''
+
+    with settings_cache_lock:
+        cached = settings_cache.get(SETTINGS_FILE)
+    if cached is not None:
+        return cached[1]
+
+    settings = sublime.load_settings(SETTINGS_FILE)
+    debug("Taking either the user_settings_file (if it exists) or the default_settings_file")
+    # debug("settings: " + str(settings))
+
+    # only the default array is needed
+    default = settings.get('default')
+
+    # but when there is a user array instead of a default array, then merge the settings
+    user = settings.get('user', {})
+    if user:
+        default = merge_user_settings(default, user)
+
+    settings = ResolvedSettings(default)
+
+    with settings_cache_lock:
+        settings_cache[SETTINGS_FILE] = (None, settings)
+    return settings
+
+
+def merge_user_settings(default, user):
+    '''Merge the "user" settings into the "default" settings.
+
+    Neither of the passed dicts is modified, a new dict is returned.'''
+
+    # merge each transformation
+    transformations = dict(default.get('transformations', {}))
+    for name, data in user.get('transformations', {}).items():
+        transformation = dict(transformations.get(name, {}))
+        transformation.update(data)
+        transformations[name] = transformation
+
+    # merge all other keys
+    merged = dict(default)
+    merged.update((key, value) for key, value in user.items() if key != 'transformations')
+    merged['transformations'] = transformations
+    return merged
+
+
+def freeze_settings(value):
+    '''Return a read-only copy of decoded settings (dicts -> mappingproxy, lists -> tuple).'''
+
+    if isinstance(value, dict):
+        return MappingProxyType(dict((key, freeze_settings(item)) for key, item in value.items()))
+    if isinstance(value, list):
+        return tuple(freeze_settings(item) for item in value)
+    return value
+
+
+def get_file_stamp(file_path):
+    '''Return (mtime, size) of a file, used to detect changes of cached files.'''
+
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size)
+
+
+def clear_settings_cache():
+
+    debug("Clearing the settings cache")
+    with settings_cache_lock:
+        settings_cache.clear()
+
+
 def search_for_folder_settings_file(file_name, folder_path, window=None):
     '''
     1. Is the settings file an absolute file path?
@@ -421,30 +3399,161 @@ def search_for_folder_settings_file(file_name, folder_path, window=None):
         return folder_path_settings_file
     debug("No!")
 
-    # 3. Is the settings file somewhere in the project?
+    # 3. Is the settings file in a parent folder inside the project?
+    #    Otherwise, is it somewhere else in the project?
     debug("Is the settings file \"" + file_name + "\" somewhere in the project?")
-    project_folders = window.folders()
-    debug("(Searching the following folders and their subfolders: " + str(project_folders) + ")")
-    if project_folders:
-        unused_head, folder_name = os.path.split(folder_path)
-        located_folder_path = None
-        for folder in project_folders:
-            for root, dirs, files in os.walk(folder, topdown=False):
-                for file in files:
-                    # debug("file_name: " + file_name)
-                    if file == file_name:
-                        located_folder_path = root
-        # debug("located_folder_path: " + located_folder_path)
-        if located_folder_path:
-            folder_settings_file = os.path.join(located_folder_path, file_name)
-            if os.path.exists(folder_settings_file):
-                debug("Yes!")
-                debug("It's in this folder: " + folder_settings_file)
-                return folder_settings_file
-        else:
-            debug("No!")
-            debug("There is no folder settings file")
-            return None
+    project_folders = window.folders() if window else []
+    indexes = [get_folder_settings_index(folder, file_name) for folder in project_folders]
+    # the deepest project folder containing the current folder comes first
+    parents = sorted((index for index in indexes if index.contains(folder_path)), key=lambda index: len(index.root), reverse=True)
+    for index in parents:
+        folder_settings_file = index.nearest(folder_path)
+        if folder_settings_file:
+            debug("Yes! It's in this folder: " + folder_settings_file)
+            return folder_settings_file
+
+    for index in indexes:
+        folder_settings_file = index.shallowest()
+        if folder_settings_file:
+            debug("Yes! It's in this folder: " + folder_settings_file)
+            return folder_settings_file
+
+    debug("No! There is no folder settings file")
+    return None
+
+
+class FolderSettingsIndex(object):
+
+    '''Locations of all folder settings files below one project folder.
+
+    The index is built once in a background thread (skipping the folders
+    matched by the "folder_settings_ignore" setting) and afterwards only
+    updated: loaded or saved settings files are added and files which do not
+    exist anymore are dropped when they are looked up.'''
+
+    def __init__(self, root, file_name, ignore):
+        self.root = root
+        self.file_name = file_name
+        self.ignore = ignore
+        # folders which contain a settings file
+        self.folders = set()
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+
+    def build(self):
+        start = time.time()
+        for root, dirs, files in os.walk(self.root):
+            dirs[:] = [name for name in dirs if not self.is_ignored(name)]
+            if self.file_name in files:
+                with self.lock:
+                    self.folders.add(root)
+        self.ready.set()
+        debug("Indexed " + self.root + " in " + str(round(time.time() - start, 3)) + "s: " + str(sorted(self.folders)))
+
+    def is_ignored(self, name):
+        return any(fnmatch.fnmatch(name, pattern) for pattern in self.ignore)
+
+    def contains(self, path):
+        return path == self.root or path.startswith(os.path.join(self.root, ''))
+
+    def add(self, folder):
+        with self.lock:
+            self.folders.add(folder)
+
+    def discard(self, folder):
+        with self.lock:
+            self.folders.discard(folder)
+
+    def has_settings_file(self, folder):
+        '''Check an indexed folder, dropping it when its settings file is gone.'''
+        with self.lock:
+            if folder not in self.folders:
+                return False
+        if os.path.isfile(os.path.join(folder, self.file_name)):
+            return True
+        self.discard(folder)
+        return False
+
+    def nearest(self, folder_path):
+        '''Return the settings file in the nearest parent folder (up to the root) of folder_path.
+
+        The parent folders are checked on disk, not in the index, so a settings file
+        created outside of Sublime is found as well (and added to the index).'''
+        folder = folder_path
+        while self.contains(folder):
+            settings_file = os.path.join(folder, self.file_name)
+            if os.path.isfile(settings_file):
+                self.add(folder)
+                return settings_file
+            self.discard(folder)
+            parent = os.path.dirname(folder)
+            if parent == folder:
+                break
+            folder = parent
+        return None
+
+    def shallowest(self):
+        '''Return the settings file closest to the root, anywhere in the project folder.
+
+        This is called on the UI thread, so it does not wait for the index to be
+        built: while it is being built, only the settings files found so far count.'''
+        if not self.ready.is_set():
+            debug("The index of " + self.root + " is still being built, using the settings files found so far")
+        with self.lock:
+            folders = sorted(self.folders, key=lambda folder: (folder.count(os.sep), folder))
+        for folder in folders:
+            if self.has_settings_file(folder):
+                return os.path.join(folder, self.file_name)
+        return None
+
+
+def get_folder_settings_index(folder, file_name="spandoc.json"):
+    '''Return the index of a project folder, starting to build it in the background if needed.'''
+
+    folder = os.path.normpath(folder)
+    with folder_settings_indexes_lock:
+        index = folder_settings_indexes.get((folder, file_name))
+        if index is not None:
+            return index
+        ignore = get_package_settings().get('folder_settings_ignore', ())
+        index = FolderSettingsIndex(folder, file_name, ignore)
+        folder_settings_indexes[(folder, file_name)] = index
+    threading.Thread(target=index.build, name='Spandoc index ' + folder, daemon=True).start()
+    return index
+
+
+def register_folder_settings_file(file_path):
+    '''Add a (new) settings file to all indexes of project folders containing it.'''
+
+    folder, file_name = os.path.split(os.path.normpath(file_path))
+    with folder_settings_indexes_lock:
+        indexes = list(folder_settings_indexes.values())
+    for index in indexes:
+        if index.file_name == file_name and index.contains(folder):
+            index.add(folder)
+
+
+class SpandocFolderSettingsListener(sublime_plugin.EventListener):
+
+    '''Keeps the folder settings indexes up to date.'''
+
+    def on_activated_async(self, view):
+        # start indexing the project folders as soon as a window is used
+        window = view.window()
+        if window:
+            for folder in window.folders():
+                get_folder_settings_index(folder)
+
+    def on_load_async(self, view):
+        self.register(view)
+
+    def on_post_save_async(self, view):
+        self.register(view)
+
+    def register(self, view):
+        file_name = view.file_name()
+        if file_name and os.path.basename(file_name) == "spandoc.json":
+            register_folder_settings_file(file_name)
 
 
 def load_folder_settings_file(folder_settings_file):
@@ -469,3 +3578,59 @@ def load_folder_settings_file(folder_settings_file):
     return settings_file
 
 
+def warm_up():
+    '''Do the work of the first conversion in advance: resolve the settings of the open
+    windows (building the indexes of their project folders) and find and probe pandoc.
+
+    A pandoc which can not be found or run is reported right away.'''
+
+    start = time.time()
+    settings_list = [get_package_settings()]
+    for window in sublime.windows():
+        for folder in window.folders():
+            index = get_folder_settings_index(folder)
+            index.ready.wait()
+            with index.lock:
+                folders = list(index.folders)
+            settings_list.extend(get_folder_settings(os.path.join(folder, index.file_name)) for folder in folders)
+        view, folder_path, unused_file_name = get_current(window)
+        if view is not None:
+            settings = get_settings(view, folder_path)
+            if settings is not None:
+                # ranks the transformations for the palette
+                settings.rank(view.scope_name(0))
+
+    checked = set()
+    for settings in settings_list:
+        if settings is None or settings.get('pandoc_path') in checked:
+            continue
+        checked.add(settings.get('pandoc_path'))
+        pandoc_path = find_pandoc(settings.get('pandoc_path'))
+        version = get_pandoc_version(pandoc_path) if pandoc_path is not None else None
+        if version is None:
+            message = 'Spandoc: pandoc can not be run, please check the "pandoc_path" setting (' + repr(settings.get('pandoc_path')) + ').'
+            print(message)
+            sublime.status_message(message)
+            continue
+        get_pandoc_formats(pandoc_path)
+        if settings.get('pandoc_backend') == 'server':
+            try:
+                get_pandoc_server(pandoc_path).ensure_running()
+            except PandocServerUnavailable as e:
+                debug("pandoc server: " + str(e))
+    debug("Warmed up in " + str(round(time.time() - start, 3)) + "s")
+
+
+def plugin_loaded():
+
+    # drop the cached settings, whenever the default/user settings file changes
+    sublime.load_settings(SETTINGS_FILE).add_on_change('spandoc-settings-cache', clear_settings_cache)
+    threading.Thread(target=warm_up, name='Spandoc warm-up', daemon=True).start()
+
+
+def plugin_unloaded():
+
+    stop_pandoc_servers()
+    if scheduler is not None:
+        scheduler.cancel_all()
+    sublime.load_settings(SETTINGS_FILE).clear_on_change('spandoc-settings-cache')
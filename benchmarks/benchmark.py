@@ -0,0 +1,442 @@
+#!/usr/bin/env python3
+'''Headless benchmarks of Spandoc.
+
+Imports Spandoc.py with the stub `sublime` and `sublime_plugin` modules of the
+stubs folder, generates a synthetic project and documents, and measures the
+search for folder settings files, the loading of the settings, the parsing of
+pandoc arguments, the ranking of the transformations for the palette and whole
+conversions with SpandocRunCommand, using a fake pandoc (fake_pandoc.py) with
+a configurable latency and output size.
+
+The results are written as JSON (to stdout or --output), so runs can be
+compared, e.g.:
+
+    python3 benchmarks/benchmark.py --quick --output before.json
+'''
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+PACKAGE_PATH = os.path.dirname(BENCHMARKS_PATH)
+
+sys.path.insert(0, os.path.join(BENCHMARKS_PATH, 'stubs'))
+sys.path.insert(1, PACKAGE_PATH)
+
+import sublime
+import Spandoc
+
+
+SIZE_UNITS = {'K': 1024, 'M': 1024 * 1024}
+
+MARKDOWN_PARAGRAPH = (
+    'Lorem ipsum dolor sit amet, *consectetur* adipiscing elit, sed do eiusmod tempor '
+    'incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud '
+    '`exercitation` ullamco laboris nisi ut aliquip ex ea commodo [consequat](http://example.com).\n\n'
+)
+
+
+class Window(object):
+
+    '''The parts of sublime.Window used by Spandoc.'''
+
+    def __init__(self, folders):
+        self._folders = folders
+        self.views = []
+        self.panels = {}
+
+    def id(self):
+        return id(self)
+
+    def folders(self):
+        return list(self._folders)
+
+    def project_data(self):
+        return {'folders': [{'path': folder} for folder in self._folders]}
+
+    def active_view(self):
+        return self.views[-1] if self.views else None
+
+    def show_quick_panel(self, items, on_select, *args, **kwargs):
+        self.quick_panel = items
+
+    def run_command(self, command, args=None):
+        pass
+
+    def new_file(self):
+        # new buffers (e.g. of buffer transformations) do not become the active view,
+        # so every run converts the same view
+        view = View(None, None)
+        view._window = self
+        return view
+
+    def open_file(self, file_name):
+        return View(self, file_name)
+
+    def focus_view(self, view):
+        pass
+
+    def create_output_panel(self, name):
+        panel = self.panels[name] = View(None, None)
+        return panel
+
+    def find_output_panel(self, name):
+        return self.panels.get(name)
+
+
+class View(object):
+
+    '''The parts of sublime.View used by Spandoc.'''
+
+    def __init__(self, window, file_name, text='', scope='text.html.markdown'):
+        self._window = window
+        self._file_name = file_name
+        self.text = text
+        self.scope = scope
+        self._settings = sublime.Settings({'syntax': 'Packages/Markdown/Markdown.sublime-syntax'})
+        self.status = {}
+        if window is not None:
+            window.views.append(self)
+
+    def id(self):
+        return id(self)
+
+    def buffer_id(self):
+        return id(self)
+
+    def window(self):
+        return self._window
+
+    def file_name(self):
+        return self._file_name
+
+    def settings(self):
+        return self._settings
+
+    def size(self):
+        return len(self.text)
+
+    def substr(self, region):
+        return self.text[region.begin():region.end()]
+
+    def scope_name(self, point):
+        return self.scope + ' '
+
+    def score_selector(self, point, selector):
+        return sublime.score_selector(self.scope_name(point), selector)
+
+    def set_status(self, key, value):
+        self.status[key] = value
+
+    def erase_status(self, key):
+        self.status.pop(key, None)
+
+    def run_command(self, command, args=None):
+        if command == 'spandoc_replace_content':
+            self.text = args['text']
+        elif command == 'append':
+            self.text += args['characters']
+
+    def set_syntax_file(self, syntax_file):
+        pass
+
+    def assign_syntax(self, syntax_file):
+        pass
+
+    def set_name(self, name):
+        pass
+
+    def set_scratch(self, scratch):
+        pass
+
+    def set_read_only(self, read_only):
+        pass
+
+    def is_loading(self):
+        return False
+
+    def is_valid(self):
+        return True
+
+    def is_dirty(self):
+        return False
+
+    def change_count(self):
+        return 0
+
+
+def parse_size(text):
+    text = text.strip().upper().rstrip('B')
+    if text[-1:] in SIZE_UNITS:
+        return int(float(text[:-1]) * SIZE_UNITS[text[-1]])
+    return int(text)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[max(1, int(-(-fraction * len(values) // 1))) - 1]
+
+
+def measure(results, name, function, repeat, setup=None, **params):
+    '''Run function repeat times (after setup, which is not timed) and add its timing to the results.'''
+
+    seconds = []
+    for unused_run in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+    result = {
+        'name': name,
+        'params': params,
+        'runs': repeat,
+        'min': min(seconds),
+        'median': percentile(seconds, 0.5),
+        'p95': percentile(seconds, 0.95),
+        'mean': sum(seconds) / len(seconds),
+    }
+    results.append(result)
+    description = ' '.join(key + '=' + str(value) for key, value in sorted(params.items()) if value is not None)
+    sys.stderr.write('{0:<32} {1:<72} median {2:9.3f} ms  p95 {3:9.3f} ms\n'.format(
+        name, description, result['median'] * 1000, result['p95'] * 1000))
+    return result
+
+
+def make_transformations(count):
+    '''Return count transformations, like the ones of the default settings.'''
+
+    transformations = {}
+    for number in range(count):
+        transformations['HTML ' + str(number)] = {
+            'scope': {'text.html.markdown': 'markdown', 'text.html.basic': 'html', 'text.restructuredtext': 'rst'},
+            'output_extension': 'html' if number else '',
+            'pandoc-arguments': ['--to=html', '--output', '--standalone', '--toc', '-V', 'lang:en', '--variable=fontsize:11pt'],
+        }
+    return transformations
+
+
+def make_project(root, folders, depth, files, settings_every, transformations):
+    '''Create a project of folders (each nested depth levels deep) with files
+    documents in every leaf folder, and a spandoc.json in the project root
+    and in every settings_every-th leaf folder (0: only the root).
+
+    Returns the paths of the documents.'''
+
+    settings = json.dumps({'default': {'pandoc_path': '', 'transformations': transformations}}, indent=2)
+    with open(os.path.join(root, 'spandoc.json'), 'w', encoding='utf-8') as settings_file:
+        settings_file.write(settings)
+
+    documents = []
+    for folder_number in range(folders):
+        folder = os.path.join(root, *['folder-{0}-{1}'.format(folder_number, level) for level in range(depth)])
+        os.makedirs(folder)
+        if settings_every and folder_number % settings_every == 0:
+            with open(os.path.join(folder, 'spandoc.json'), 'w', encoding='utf-8') as settings_file:
+                settings_file.write(settings)
+        for file_number in range(files):
+            document = os.path.join(folder, 'document-{0}.md'.format(file_number))
+            with open(document, 'w', encoding='utf-8') as document_file:
+                document_file.write('# Document {0}\n\n{1}'.format(file_number, MARKDOWN_PARAGRAPH))
+            documents.append(document)
+    return documents
+
+
+def make_document(path, size):
+    '''Write a markdown document of (about) size bytes, with a heading every 20 paragraphs.'''
+
+    section = ''.join(['## Section\n\n'] + [MARKDOWN_PARAGRAPH] * 20).encode('utf-8')
+    with open(path, 'wb') as document:
+        document.write(b'# Synthetic document\n\n')
+        written = 0
+        while written + len(section) <= size:
+            document.write(section)
+            written += len(section)
+        document.write(section[:max(size - written, 0)])
+
+
+def make_fake_pandoc(folder):
+    '''Return an executable running fake_pandoc.py with this Python.'''
+
+    script = os.path.join(BENCHMARKS_PATH, 'fake_pandoc.py')
+    if os.name == 'nt':
+        path = os.path.join(folder, 'pandoc.cmd')
+        with open(path, 'w') as launcher:
+            launcher.write('@"{0}" "{1}" %*\n'.format(sys.executable, script))
+        return path
+    path = os.path.join(folder, 'pandoc')
+    with open(script, encoding='utf-8') as source, open(path, 'w', encoding='utf-8') as launcher:
+        launcher.write('#!' + sys.executable + '\n' + source.read())
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return path
+
+
+def wait_for_jobs():
+    '''Wait until the job scheduler of Spandoc has run all conversions.'''
+
+    while Spandoc.scheduler is not None and (Spandoc.scheduler.workers or Spandoc.scheduler.running):
+        time.sleep(0.0005)
+
+
+def reset_caches():
+    Spandoc.clear_settings_cache()
+    with Spandoc.folder_settings_indexes_lock:
+        Spandoc.folder_settings_indexes.clear()
+
+
+def benchmark_settings(results, options, root, documents, transformations):
+    window = Window([root])
+    sublime._windows[:] = [window]
+    deepest = documents[-1]
+    shallowest = os.path.join(root, 'document.md')
+    repeat = options.repeat
+
+    for label, document in (('project root', shallowest), ('deepest folder', deepest)):
+        folder_path = os.path.dirname(document)
+        params = {'file': label, 'folders': options.folders, 'depth': options.depth, 'files': options.files}
+        measure(results, 'search_for_folder_settings_file', lambda: Spandoc.search_for_folder_settings_file('spandoc.json', folder_path, window),
+            repeat, setup=reset_caches, cache='cold', **params)
+        measure(results, 'search_for_folder_settings_file', lambda: Spandoc.search_for_folder_settings_file('spandoc.json', folder_path, window),
+            repeat, cache='warm', **params)
+
+        view = View(window, document)
+        measure(results, 'get_settings', lambda: Spandoc.get_settings(view, folder_path), repeat, setup=reset_caches,
+            cache='cold', transformations=len(transformations), **params)
+        measure(results, 'get_settings', lambda: Spandoc.get_settings(view, folder_path), repeat,
+            cache='warm', transformations=len(transformations), **params)
+        window.views.remove(view)
+
+    arguments = transformations['HTML 0']['pandoc-arguments']
+    long_arguments = list(arguments) * 20
+    measure(results, 'PandocArguments', lambda: Spandoc.PandocArguments(arguments), repeat * 10, arguments=len(arguments))
+    measure(results, 'PandocArguments', lambda: Spandoc.PandocArguments(long_arguments), repeat * 10, arguments=len(long_arguments))
+
+    view = View(window, deepest)
+    settings = Spandoc.get_settings(view, os.path.dirname(deepest))
+    palette = Spandoc.SpandocPaletteCommand(window)
+    measure(results, 'get_transformation_list', lambda: palette.get_transformation_list(settings, view), repeat,
+        setup=lambda: settings.rankings.clear(), cache='cold', transformations=len(transformations))
+    measure(results, 'get_transformation_list', lambda: palette.get_transformation_list(settings, view), repeat,
+        cache='warm', transformations=len(transformations))
+    window.views.remove(view)
+
+
+def benchmark_conversions(results, options, root, pandoc_path):
+    folder = os.path.join(root, 'documents')
+    os.makedirs(folder)
+    window = Window([folder])
+    sublime._windows[:] = [window]
+    sublime.load_settings(Spandoc.SETTINGS_FILE).set('user', {'pandoc_path': pandoc_path})
+    reset_caches()
+
+    os.environ['SPANDOC_FAKE_PANDOC_LATENCY'] = str(options.latency / 1000.0)
+    if options.output_size is not None:
+        os.environ['SPANDOC_FAKE_PANDOC_OUTPUT_SIZE'] = str(options.output_size)
+
+    for size in options.sizes:
+        document = os.path.join(folder, 'document-{0}.md'.format(size))
+        make_document(document, size)
+        for transformation in ('HTML', 'Markdown (Pandoc) to Buffer'):
+            if transformation == 'HTML':
+                view = View(window, document, scope='text.html.markdown')
+            else:
+                # buffer transformations convert the content of the view
+                with open(document, encoding='utf-8') as source:
+                    view = View(window, document, source.read(), scope='text.html.basic')
+            command = Spandoc.SpandocRunCommand(window)
+            with Spandoc.timings_lock:
+                Spandoc.timings.clear()
+            del sublime.messages[:]
+            repeat = max(1, options.repeat // 10) if size >= SIZE_UNITS['M'] else options.repeat
+            # the command only queues the conversion
+            run = lambda: (command.run(transformation), wait_for_jobs())
+            result = measure(results, 'SpandocRunCommand', run, repeat,
+                transformation=transformation, size=size, latency_ms=options.latency, output_size=options.output_size)
+
+            errors = [message for kind, message in sublime.messages if kind == 'error']
+            if errors:
+                result['errors'] = errors
+            # the stages, as timed by Spandoc itself
+            with Spandoc.timings_lock:
+                entries = list(Spandoc.timings)
+            stages = {}
+            for entry in entries:
+                for stage, seconds in entry['stages'].items():
+                    stages.setdefault(stage, []).append(seconds)
+            result['stages'] = dict((stage, percentile(seconds, 0.5)) for stage, seconds in stages.items())
+            window.views.remove(view)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--folders', type=int, default=50, help='folders of the synthetic project')
+    parser.add_argument('--depth', type=int, default=3, help='nesting depth of every folder')
+    parser.add_argument('--files', type=int, default=10, help='documents per folder')
+    parser.add_argument('--settings-every', type=int, default=5, help='put a spandoc.json in every n-th folder (0: only in the root)')
+    parser.add_argument('--transformations', type=int, default=30, help='transformations in the settings')
+    parser.add_argument('--sizes', default='1K,100K,1M,10M,50M', help='sizes of the converted documents, e.g. "1K,10M"')
+    parser.add_argument('--latency', type=float, default=0, help='latency of the fake pandoc in ms')
+    parser.add_argument('--output-size', type=parse_size, default=None, help='output size of the fake pandoc (default: the input size)')
+    parser.add_argument('--repeat', type=int, default=20, help='runs per measurement')
+    parser.add_argument('--quick', action='store_true', help='small project and documents, few runs')
+    parser.add_argument('--output', help='write the results to this file instead of stdout')
+    parser.add_argument('--debug', action='store_true', help='print the debug messages of Spandoc')
+    options = parser.parse_args(argv)
+    Spandoc.DEBUG_MODE = options.debug
+    if options.quick:
+        options.folders, options.files, options.repeat, options.sizes = 10, 3, 5, '1K,100K'
+    options.sizes = [parse_size(size) for size in options.sizes.split(',') if size.strip()]
+
+    root = tempfile.mkdtemp(prefix='spandoc-benchmark-')
+    sublime.CACHE_PATH = os.path.join(root, 'cache')
+    sublime.PACKAGES_PATH = os.path.join(root, 'packages')
+    results = []
+    try:
+        pandoc_path = make_fake_pandoc(root)
+        project = os.path.join(root, 'project')
+        os.makedirs(project)
+        transformations = make_transformations(options.transformations)
+        documents = make_project(project, options.folders, options.depth, options.files, options.settings_every, transformations)
+        benchmark_settings(results, options, project, documents, transformations)
+        benchmark_conversions(results, options, root, pandoc_path)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'commit': get_commit(),
+        },
+        'options': dict((key, value) for key, value in vars(options).items() if key != 'output'),
+        'results': results,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w', encoding='utf-8') as output:
+            output.write(text + '\n')
+    else:
+        sys.stdout.write(text + '\n')
+    return 0
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=PACKAGE_PATH, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+'''A fake pandoc for the benchmarks: it answers like pandoc, but only copies its
+input (or writes filler) to its output, after a configurable delay.
+
+Environment variables:
+    SPANDOC_FAKE_PANDOC_LATENCY      seconds to sleep before converting (default 0)
+    SPANDOC_FAKE_PANDOC_OUTPUT_SIZE  size of the output in bytes (default: the size of the input)
+'''
+
+import os
+import sys
+import time
+
+
+def main(args):
+    if args == ['--version']:
+        sys.stdout.write('pandoc 3.1.0\nFake pandoc of the Spandoc benchmarks\n')
+        return 0
+    if args and args[0] in ('--list-input-formats', '--list-output-formats'):
+        sys.stdout.write('commonmark\nhtml\njson\nlatex\nmarkdown\nplain\n')
+        return 0
+
+    output = None
+    input_file = None
+    position = 0
+    while position < len(args):
+        arg = args[position]
+        position += 1
+        if arg in ('-o', '--output') and position < len(args):
+            output = args[position]
+            position += 1
+        elif arg.startswith('--output='):
+            output = arg[len('--output='):]
+        elif arg in ('-f', '-r', '-t', '-w', '-V', '-M', '-c', '-H', '-B', '-A', '-F', '-L', '-d'):
+            # short option with a value
+            position += 1
+        elif not arg.startswith('-'):
+            input_file = arg
+
+    time.sleep(float(os.environ.get('SPANDOC_FAKE_PANDOC_LATENCY') or 0))
+
+    if input_file is not None:
+        with open(input_file, 'rb') as source:
+            data = source.read()
+    else:
+        data = sys.stdin.buffer.read()
+
+    output_size = os.environ.get('SPANDOC_FAKE_PANDOC_OUTPUT_SIZE')
+    if output_size:
+        output_size = int(output_size)
+        data = (data or b'x') * (output_size // max(len(data), 1) + 1)
+        data = data[:output_size]
+
+    if output is None or output == '-':
+        sys.stdout.buffer.write(data)
+    else:
+        with open(output, 'wb') as target:
+            target.write(data)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,145 @@
+'''A minimal stand-in for the `sublime` module of Sublime Text, so Spandoc.py can be
+imported and run outside of Sublime by the benchmarks.
+
+Only the parts of the API used by Spandoc are implemented. Callbacks passed to
+set_timeout/set_timeout_async run immediately, on the calling thread.'''
+
+import json
+import os
+import re
+import tempfile
+import threading
+
+
+PACKAGE_PATH = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# set by the benchmark, e.g. to a temporary directory
+CACHE_PATH = os.path.join(tempfile.gettempdir(), 'spandoc-benchmark-cache')
+PACKAGES_PATH = os.path.join(tempfile.gettempdir(), 'spandoc-benchmark-packages')
+
+# the messages shown by status_message/error_message/message_dialog: [(kind, message)]
+messages = []
+messages_lock = threading.Lock()
+
+_settings = {}
+_windows = []
+
+
+class Settings(object):
+
+    def __init__(self, values=None):
+        self.values = dict(values or {})
+        self.callbacks = {}
+
+    def get(self, key, default=None):
+        # Sublime returns copies
+        return json.loads(json.dumps(self.values.get(key, default)))
+
+    def set(self, key, value):
+        self.values[key] = value
+        for callback in list(self.callbacks.values()):
+            callback()
+
+    def has(self, key):
+        return key in self.values
+
+    def erase(self, key):
+        self.values.pop(key, None)
+
+    def add_on_change(self, tag, callback):
+        self.callbacks[tag] = callback
+
+    def clear_on_change(self, tag):
+        self.callbacks.pop(tag, None)
+
+
+class Region(object):
+
+    def __init__(self, a, b=None):
+        self.a = a
+        self.b = a if b is None else b
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+
+# "//" comments (outside of strings) and trailing commas of Sublime's JSON
+JSON_COMMENT_PATTERN = re.compile(r'("(?:\\.|[^"\\])*")|//[^\n]*|/\*.*?\*/', re.DOTALL)
+JSON_TRAILING_COMMA_PATTERN = re.compile(r',(\s*[}\]])')
+
+
+def decode_value(text):
+    text = JSON_COMMENT_PATTERN.sub(lambda match: match.group(1) or '', text)
+    return json.loads(JSON_TRAILING_COMMA_PATTERN.sub(r'\1', text))
+
+
+def load_settings(name):
+    if name not in _settings:
+        values = {}
+        path = os.path.join(PACKAGE_PATH, name)
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as settings_file:
+                values = decode_value(settings_file.read())
+        _settings[name] = Settings(values)
+    return _settings[name]
+
+
+def status_message(message):
+    with messages_lock:
+        messages.append(('status', message))
+
+
+def error_message(message):
+    with messages_lock:
+        messages.append(('error', message))
+
+
+def message_dialog(message):
+    with messages_lock:
+        messages.append(('dialog', message))
+
+
+def set_timeout(callback, delay=0):
+    callback()
+
+
+def set_timeout_async(callback, delay=0):
+    callback()
+
+
+def cache_path():
+    return CACHE_PATH
+
+
+def packages_path():
+    return PACKAGES_PATH
+
+
+def platform():
+    return {'nt': 'windows', 'darwin': 'osx'}.get(os.name, 'linux')
+
+
+def windows():
+    return list(_windows)
+
+
+def active_window():
+    return _windows[0] if _windows else None
+
+
+def score_selector(scope_name, selector):
+    '''Score a selector (alternatives separated by ",") against a scope name: the
+    number of matched scope atoms, 0 when it does not match.'''
+
+    best = 0
+    for alternative in selector.split(','):
+        alternative = alternative.strip()
+        if not alternative:
+            continue
+        for scope in scope_name.split():
+            if scope == alternative or scope.startswith(alternative + '.'):
+                best = max(best, alternative.count('.') + 1)
+    return best
@@ -0,0 +1,23 @@
+'''A minimal stand-in for the `sublime_plugin` module of Sublime Text, see sublime.py.'''
+
+
+class WindowCommand(object):
+
+    def __init__(self, window):
+        self.window = window
+
+
+class TextCommand(object):
+
+    def __init__(self, view):
+        self.view = view
+
+
+class EventListener(object):
+    pass
+
+
+class ViewEventListener(object):
+
+    def __init__(self, view):
+        self.view = view
@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+'''The Spandoc worker: one local process, shared by all Sublime windows (and Sublime
+instances) of a user, which runs pandoc for Spandoc with `"pandoc_backend": "worker"`.
+
+It is started on demand by the plugin and listens on a Unix domain socket. A request
+is one line of JSON, it is answered by one line of JSON and the connection is closed:
+
+    {"command": "convert", "cmd": [pandoc, ...], "cwd": folder, "input": base64 or null,
+     "output": output file or null, "files": [files the output depends on]}
+    -> {"ok": true, "output": base64 (stdout), "stderr": "...", "cached": false}
+    -> {"ok": false, "error": "...", "stderr": "..."}
+
+    {"command": "health"}    -> {"ok": true, "pid": ..., "uptime": ..., ...}
+    {"command": "shutdown"}  -> {"ok": true}
+
+The outputs of conversions are kept in memory (up to --cache-size MB), keyed by the
+pandoc version, the command, its folder, the input and the modification times and
+sizes of the files. Identical conversions requested at once share one pandoc run, and
+at most --jobs pandoc processes run at once. The worker exits after --idle-timeout
+seconds without requests. When the plugin closes the connection of a conversion
+(it was cancelled), its pandoc process is killed.
+'''
+
+import argparse
+import base64
+import collections
+import hashlib
+import json
+import os
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+
+
+# the last bytes of stderr, which are returned
+ERROR_TAIL_SIZE = 64 * 1024
+
+
+class OutputCache(object):
+
+    '''Outputs of conversions in memory, the least recently used are dropped first.'''
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        entry_size = len(entry['stdout']) + len(entry['file'] or b'')
+        if entry_size > self.max_size:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = entry
+            self.size += entry_size
+            while self.size > self.max_size:
+                unused_key, dropped = self.entries.popitem(last=False)
+                self.size -= len(dropped['stdout']) + len(dropped['file'] or b'')
+
+
+class Worker(object):
+
+    def __init__(self, socket_path, idle_timeout, cache_size, jobs):
+        self.socket_path = socket_path
+        self.idle_timeout = idle_timeout
+        self.cache = OutputCache(cache_size)
+        self.pandoc_slots = threading.BoundedSemaphore(jobs)
+        self.jobs = jobs
+        self.started = time.time()
+        self.last_request = time.time()
+        self.lock = threading.Lock()
+        # conversions running: {cache key: Event set when done}
+        self.running = {}
+        # pandoc versions: {pandoc path: first line of `pandoc --version`}
+        self.versions = {}
+        self.counts = collections.Counter()
+        self.server = None
+
+    def handle(self, request, cancellation=None):
+        with self.lock:
+            self.last_request = time.time()
+            self.counts['requests'] += 1
+        command = request.get('command')
+        if command == 'convert':
+            return self.convert(request, cancellation or Cancellation())
+        if command == 'health':
+            return self.health()
+        if command == 'shutdown':
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+            return {'ok': True}
+        return {'ok': False, 'error': 'Unknown command: ' + str(command)}
+
+    def convert(self, request, cancellation):
+        cmd = request['cmd']
+        cwd = request.get('cwd')
+        contents = base64.b64decode(request['input']) if request.get('input') is not None else None
+        output = request.get('output')
+        key = self.get_key(cmd, cwd, contents, request.get('files') or ())
+
+        # wait for an identical conversion already running, then take its output from the cache
+        with self.lock:
+            done = self.running.get(key)
+            if done is None:
+                done = self.running[key] = threading.Event()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            done.wait()
+            with self.lock:
+                self.counts['shared'] += 1
+        try:
+            if cancellation.cancelled:
+                return CANCELLED
+            entry = self.cache.get(key)
+            if entry is not None:
+                with self.lock:
+                    self.counts['hits'] += 1
+                if output is not None and entry['file'] is not None:
+                    write_file(output, entry['file'])
+                return {'ok': True, 'output': encode(entry['stdout']), 'stderr': entry['stderr'], 'cached': True}
+
+            with self.pandoc_slots:
+                if cancellation.cancelled:
+                    return CANCELLED
+                returncode, stdout, stderr = run_pandoc(cmd, cwd, contents, cancellation)
+            with self.lock:
+                self.counts['conversions'] += 1
+            if cancellation.cancelled:
+                with self.lock:
+                    self.counts['cancelled'] += 1
+                return CANCELLED
+            if returncode != 0:
+                return {'ok': False, 'error': stderr.strip() or 'pandoc exited with code ' + str(returncode), 'stderr': stderr}
+
+            file_output = None
+            if output is not None:
+                try:
+                    with open(output, 'rb') as output_file:
+                        file_output = output_file.read()
+                except OSError:
+                    pass
+            self.cache.put(key, {'stdout': stdout, 'file': file_output, 'stderr': stderr})
+            return {'ok': True, 'output': encode(stdout), 'stderr': stderr, 'cached': False}
+        finally:
+            if owner:
+                with self.lock:
+                    self.running.pop(key, None)
+                done.set()
+
+    def get_key(self, cmd, cwd, contents, files):
+        key = hashlib.sha256()
+        key.update(str(self.get_version(cmd[0])).encode('utf-8'))
+        key.update(json.dumps([cmd, cwd]).encode('utf-8'))
+        key.update(b'\0input' if contents is None else contents)
+        for file_path in files:
+            try:
+                stat = os.stat(os.path.join(cwd or '', file_path))
+                stamp = [file_path, stat.st_mtime, stat.st_size]
+            except (OSError, TypeError):
+                stamp = [file_path, None]
+            key.update(json.dumps(stamp).encode('utf-8'))
+        return key.hexdigest()
+
+    def get_version(self, pandoc_path):
+        with self.lock:
+            if pandoc_path in self.versions:
+                return self.versions[pandoc_path]
+        try:
+            output = subprocess.check_output([pandoc_path, '--version'], stdin=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            version = output.decode('utf-8', 'replace').splitlines()[0].strip()
+        except (OSError, subprocess.CalledProcessError, IndexError):
+            version = None
+        with self.lock:
+            self.versions[pandoc_path] = version
+        return version
+
+    def health(self):
+        with self.lock:
+            return {
+                'ok': True,
+                'pid': os.getpid(),
+                'python': sys.version.split()[0],
+                'socket': self.socket_path,
+                'uptime': round(time.time() - self.started, 1),
+                'idle': round(time.time() - self.last_request, 1),
+                'idle_timeout': self.idle_timeout,
+                'jobs': self.jobs,
+                'running': len(self.running),
+                'requests': self.counts['requests'],
+                'conversions': self.counts['conversions'],
+                'cache_hits': self.counts['hits'],
+                'shared': self.counts['shared'],
+                'cancelled': self.counts['cancelled'],
+                'cache_entries': len(self.cache.entries),
+                'cache_size': self.cache.size,
+                'pandoc': self.versions,
+            }
+
+    def watch_idle(self, active):
+        '''Shut the server down, when it has not been used for idle_timeout seconds.'''
+
+        while True:
+            time.sleep(1)
+            with self.lock:
+                idle = time.time() - self.last_request
+            if idle > self.idle_timeout and not active[0]:
+                self.server.shutdown()
+                return
+
+
+class Cancellation(object):
+
+    '''Whether the plugin has given up a conversion, and the pandoc process to kill then.'''
+
+    def __init__(self):
+        self.cancelled = False
+        self.process = None
+        self.lock = threading.Lock()
+
+    def started(self, process):
+        with self.lock:
+            self.process = process
+            cancelled = self.cancelled
+        if cancelled:
+            kill(process)
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            process = self.process
+        if process is not None:
+            kill(process)
+
+    def watch(self, connection):
+        '''Cancel, when the plugin closes the connection (it sends nothing after the request).'''
+
+        def wait():
+            try:
+                data = connection.recv(1)
+            except OSError:
+                data = b''
+            if not data:
+                self.cancel()
+
+        threading.Thread(target=wait, daemon=True).start()
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        worker = self.server.worker
+        with worker.lock:
+            self.server.active[0] += 1
+        cancellation = Cancellation()
+        try:
+            try:
+                request = json.loads(self.rfile.readline().decode('utf-8'))
+                cancellation.watch(self.connection)
+                response = worker.handle(request, cancellation)
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                response = {'ok': False, 'error': 'Bad request: ' + repr(e)}
+            try:
+                self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            except OSError:
+                # the plugin has cancelled the conversion
+                pass
+        finally:
+            # the conversion is done, closing the connection does not cancel it anymore
+            with cancellation.lock:
+                cancellation.process = None
+            with worker.lock:
+                self.server.active[0] -= 1
+                worker.last_request = time.time()
+
+
+class WorkerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+
+# the response to a cancelled conversion (which the plugin does not read anymore)
+CANCELLED = {'ok': False, 'error': 'Cancelled', 'cancelled': True}
+
+
+def run_pandoc(cmd, cwd, contents, cancellation):
+    '''Run pandoc, return (exit code, stdout, the tail of stderr as text).'''
+
+    try:
+        process = subprocess.Popen(cmd, stdin=subprocess.PIPE if contents is not None else subprocess.DEVNULL,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd or None)
+    except OSError as e:
+        return (-1, b'', 'Could not run ' + ' '.join(cmd) + ': ' + str(e))
+    cancellation.started(process)
+    stdout, stderr = process.communicate(contents)
+    return (process.returncode, stdout, stderr[-ERROR_TAIL_SIZE:].decode('utf-8', 'replace'))
+
+
+def kill(process):
+
+    if process.poll() is None:
+        try:
+            process.kill()
+        except OSError:
+            pass
+
+
+def write_file(file_path, data):
+
+    # replace (not write into) the file, a reader never sees a half written output
+    temporary_path = file_path + '.spandoc-worker'
+    with open(temporary_path, 'wb') as output_file:
+        output_file.write(data)
+    os.replace(temporary_path, file_path)
+
+
+def encode(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+def is_running(socket_path):
+    '''Check whether a worker answers on the socket.'''
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(1)
+        sock.connect(socket_path)
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='The Spandoc worker, see the docstring of this file.')
+    parser.add_argument('--socket', required=True, help='path of the Unix domain socket')
+    parser.add_argument('--idle-timeout', type=float, default=600, help='seconds without requests, after which the worker exits')
+    parser.add_argument('--cache-size', type=float, default=64, help='size of the output cache in MB')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='maximum number of pandoc processes running at once')
+    options = parser.parse_args(args)
+
+    if os.path.exists(options.socket):
+        if is_running(options.socket):
+            # started twice at once, the other worker serves
+            return 0
+        os.remove(options.socket)
+
+    # only the user may connect: the socket is in a folder only the user can enter (the umask
+    # of the worker is left alone, the pandoc processes and the outputs inherit it)
+    socket_folder = os.path.dirname(os.path.abspath(options.socket))
+    os.makedirs(socket_folder, mode=0o700, exist_ok=True)
+    os.chmod(socket_folder, 0o700)
+    worker = Worker(options.socket, options.idle_timeout, int(options.cache_size * 1024 * 1024), max(options.jobs, 1))
+    try:
+        server = WorkerServer(options.socket, RequestHandler)
+    except OSError:
+        if is_running(options.socket):
+            return 0
+        raise
+    os.chmod(options.socket, 0o600)
+    server.worker = worker
+    server.active = [0]
+    worker.server = server
+    threading.Thread(target=worker.watch_idle, args=(server.active,), daemon=True).start()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        try:
+            os.remove(options.socket)
+        except OSError:
+            pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))